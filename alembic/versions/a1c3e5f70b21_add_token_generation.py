@@ -0,0 +1,41 @@
+"""add token generation
+
+Revision ID: a1c3e5f70b21
+Revises: 130b5c2275d8
+Create Date: 2026-10-18 10:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import Column, Integer
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70b21'
+down_revision = '130b5c2275d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    token_state = op.create_table(
+        'token_state',
+        Column('id', Integer, primary_key=True),
+        Column('generation', Integer, nullable=False, default=0),
+        Column('purge_generation', Integer, nullable=False, default=0)
+    )
+    op.bulk_insert(token_state, [{'id': 1, 'generation': 0, 'purge_generation': 0}])
+
+    with op.batch_alter_table('tokens') as batch_op:
+        batch_op.add_column(Column('generation', Integer, default=0))
+        batch_op.create_index('ix_tokens_generation', ['generation'])
+
+    op.execute('update tokens set generation=0')
+
+
+def downgrade():
+    with op.batch_alter_table('tokens') as batch_op:
+        batch_op.drop_index('ix_tokens_generation')
+        batch_op.drop_column('generation')
+
+    op.drop_table('token_state')
@@ -0,0 +1,32 @@
+"""create token leases table
+
+Revision ID: b7d2f0c4a9e3
+Revises: a1c3e5f70b21
+Create Date: 2026-10-18 11:03:52.781640
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import Column, String, DateTime, ForeignKey
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2f0c4a9e3'
+down_revision = 'a1c3e5f70b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'token_leases',
+        Column('id', String(32), primary_key=True),
+        Column('token', String(255), ForeignKey('tokens.name'), nullable=False),
+        Column('expires_at', DateTime, nullable=False)
+    )
+    op.create_index('ix_token_leases_expires_at', 'token_leases', ['expires_at'])
+
+
+def downgrade():
+    op.drop_index('ix_token_leases_expires_at', table_name='token_leases')
+    op.drop_table('token_leases')
@@ -0,0 +1,30 @@
+"""add token activity index
+
+Revision ID: c4e8a2d61f57
+Revises: b7d2f0c4a9e3
+Create Date: 2026-10-18 12:26:09.114372
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a2d61f57'
+down_revision = 'b7d2f0c4a9e3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # tokens created before the disabled column had a default may still be null
+    op.execute('update tokens set disabled=false where disabled is null')
+    op.create_index(
+        'ix_tokens_disabled_expiration_date',
+        'tokens',
+        ['disabled', 'expiration_date']
+    )
+
+
+def downgrade():
+    op.drop_index('ix_tokens_disabled_expiration_date', table_name='tokens')
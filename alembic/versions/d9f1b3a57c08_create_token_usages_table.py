@@ -0,0 +1,165 @@
+"""create token usages table
+
+Revision ID: d9f1b3a57c08
+Revises: c4e8a2d61f57
+Create Date: 2026-10-18 13:41:27.530918
+
+"""
+import ipaddress
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import Column, Integer, String, DateTime, LargeBinary, ForeignKey
+
+
+# revision identifiers, used by Alembic.
+revision = 'd9f1b3a57c08'
+down_revision = 'c4e8a2d61f57'
+branch_labels = None
+depends_on = None
+
+# rows read and written at once
+BATCH_SIZE = 1000
+
+
+def pack(address):
+    try:
+        ip = ipaddress.ip_address(address.strip())
+    except ValueError:
+        return None
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.packed
+
+
+def address_ids(conn, addresses, packed):
+    """
+    returns the ids of the packed addresses, inserting the new ones
+    """
+    query = sa.select(addresses.c.packed, addresses.c.id).where(
+        addresses.c.packed.in_(packed)
+    )
+    ids = dict(conn.execute(query).fetchall())
+    new = sorted(packed - ids.keys())
+    if new:
+        op.bulk_insert(addresses, [{'packed': p} for p in new])
+        ids = dict(conn.execute(query).fetchall())
+    return ids
+
+
+def upgrade():
+    conn = op.get_bind()
+
+    addresses = op.create_table(
+        'addresses',
+        Column('id', Integer, primary_key=True),
+        Column('packed', LargeBinary(16), nullable=False, unique=True)
+    )
+    token_usages = op.create_table(
+        'token_usages',
+        Column('id', Integer, primary_key=True),
+        Column('token', String(255), ForeignKey('tokens.name'), nullable=False),
+        Column('used_at', DateTime, nullable=True)
+    )
+    op.create_index('ix_token_usages_token', 'token_usages', ['token'])
+    token_usage_addresses = op.create_table(
+        'token_usage_addresses',
+        Column('usage_id', Integer, ForeignKey('token_usages.id'), primary_key=True),
+        Column('position', Integer, primary_key=True),
+        Column('address_id', Integer, ForeignKey('addresses.id'), nullable=False)
+    )
+
+    # every logged ip row was one use and held the whole comma separated
+    # chain, rows are converted in batches so big tables don't have to fit
+    # in memory. The table is new, so usage ids can be handed out here.
+    last = (0, '')
+    usage_id = 0
+    while True:
+        rows = conn.execute(sa.text(
+            'select association.ips, association.tokens, ips.address '
+            'from association join ips on ips.id = association.ips '
+            'where association.ips > :ip or '
+            '(association.ips = :ip and association.tokens > :token) '
+            'order by association.ips, association.tokens limit :limit'
+        ), {'ip': last[0], 'token': last[1], 'limit': BATCH_SIZE}).fetchall()
+        if not rows:
+            break
+        last = rows[-1][:2]
+        usages = []
+        for _, token, address in rows:
+            usage_id += 1
+            chain = []
+            for p in map(pack, (address or '').split(',')):
+                if p and p not in chain:
+                    chain.append(p)
+            usages.append((usage_id, token, chain))
+        ids = address_ids(conn, addresses, {p for *_, chain in usages for p in chain})
+        op.bulk_insert(token_usages, [
+            {'id': usage_id, 'token': token, 'used_at': None}
+            for usage_id, token, _ in usages
+        ])
+        chains = [
+            {'usage_id': usage_id, 'position': position, 'address_id': ids[p]}
+            for usage_id, _, chain in usages
+            for position, p in enumerate(chain)
+        ]
+        if chains:
+            op.bulk_insert(token_usage_addresses, chains)
+
+    op.drop_table('association')
+    op.drop_table('ips')
+
+
+def downgrade():
+    conn = op.get_bind()
+
+    ips = op.create_table(
+        'ips',
+        Column('id', Integer, primary_key=True),
+        Column('address', String(255), nullable=True)
+    )
+    association = op.create_table(
+        'association',
+        Column('ips', Integer, ForeignKey('ips.id'), primary_key=True),
+        Column('tokens', String(255), ForeignKey('tokens.name'), primary_key=True)
+    )
+
+    # uses without logged addresses had no ip row
+    n = 0
+    while True:
+        usages = conn.execute(sa.text(
+            'select token_usages.id, token_usages.token '
+            'from token_usages where token_usages.id > :id '
+            'and exists (select 1 from token_usage_addresses '
+            'where token_usage_addresses.usage_id = token_usages.id) '
+            'order by token_usages.id limit :limit'
+        ), {'id': n, 'limit': BATCH_SIZE}).fetchall()
+        if not usages:
+            break
+        n = usages[-1][0]
+        chains = {}
+        for usage_id, packed in conn.execute(sa.text(
+            'select token_usage_addresses.usage_id, addresses.packed '
+            'from token_usage_addresses '
+            'join addresses on addresses.id = token_usage_addresses.address_id '
+            'where token_usage_addresses.usage_id > :first '
+            'and token_usage_addresses.usage_id <= :last '
+            'order by token_usage_addresses.usage_id, '
+            'token_usage_addresses.position'
+        ), {'first': usages[0][0] - 1, 'last': n}):
+            chains.setdefault(usage_id, []).append(
+                str(ipaddress.ip_address(packed))
+            )
+        op.bulk_insert(ips, [
+            {'id': usage_id, 'address': ', '.join(chains[usage_id])}
+            for usage_id, _ in usages
+        ])
+        op.bulk_insert(association, [
+            {'ips': usage_id, 'tokens': token}
+            for usage_id, token in usages
+        ])
+
+    op.drop_table('token_usage_addresses')
+    op.drop_index('ix_token_usages_token', table_name='token_usages')
+    op.drop_table('token_usages')
+    op.drop_table('addresses')
@@ -1,18 +1,22 @@
 # Standard library imports...
+import hashlib
 import logging
 import os
 import re
 from datetime import datetime
+from urllib.parse import urlencode
 
 # Third-party imports...
 from flask import (
     Blueprint,
+    Response,
     abort,
+    current_app,
     jsonify,
     request,
     make_response,
     render_template,
-    send_file,
+    url_for,
 )
 from flask_httpauth import HTTPTokenAuth
 from requests import exceptions
@@ -22,17 +26,48 @@ from wtforms import Form, StringField, PasswordField, validators
 # Local imports...
 from . import config
 from . import tokens
+from .assets import IMMUTABLE, REVALIDATE, load_asset
+from .caching import cached_page
 from .constants import __location__
-from .limiter import limiter, get_default_rate_limit
-from .matrix_api import create_account
-from .translation import get_translations
+from .limiter import (
+    Budget,
+    limiter,
+    get_default_rate_limit,
+    get_real_user_ip,
+    get_registration_rate_limit,
+    get_username_check_rate_limit,
+)
+from .matrix_api import (
+    create_account,
+    get_admission_control,
+    get_username_cache,
+    username_available,
+    HomeserverBusy,
+    HomeserverUnavailable,
+    UsernameTaken,
+    _breakers,
+)
+from .translation import get_translations, negotiate
 
 auth = HTTPTokenAuth(scheme="SharedSecret")
 logger = logging.getLogger(__name__)
 
+# number of tokens listed per page
+DEFAULT_TOKEN_PAGE = 100
+MAX_TOKEN_PAGE = 1000
+
 api = Blueprint("api", __name__)
 healthcheck = Blueprint("healthcheck", __name__)
-limiter.limit(get_default_rate_limit)(api)
+# views of the api that are requested along with a page, like images
+RATE_LIMIT_EXEMPT = {"api.element_logo"}
+limiter.limit(
+    get_default_rate_limit, exempt_when=lambda: request.endpoint in RATE_LIMIT_EXEMPT
+)(api)
+limiter.exempt(healthcheck)
+# registration requests are charged by their outcome instead
+attempts = Budget("register", get_default_rate_limit)
+# requests that reach the homeserver
+registrations = Budget("registration", get_registration_rate_limit)
 
 
 def validate_token(form, token):
@@ -51,7 +86,8 @@ def validate_token(form, token):
         Token is invalid
 
     """
-    tokens.tokens.load()
+    if not tokens.tokens.known(token.data, get_real_user_ip()):
+        raise validators.ValidationError("Token is invalid")
     if not tokens.tokens.active(token.data):
         raise validators.ValidationError("Token is invalid")
 
@@ -71,25 +107,9 @@ def validate_username(form, username):
     ValidationError
         Username doesn't follow mxid requirements
     """
-    re_mxid = f"^(?P<at>@)?(?P<username>[a-zA-Z_\-=\.\/0-9]+)(?P<server_name>:{re.escape(config.config.server_name)})?$"
-    match = re.search(re_mxid, username.data)
-    if not match:
-        raise validators.ValidationError(
-            f"Username doesn't follow mxid pattern: /{re_mxid}/"
-        )
-    username = match.group("username")
-    for e in [
-        validators.ValidationError(f"Username does not follow custom pattern /{x}/")
-        for x in config.config.username["validation_regex"]
-        if not re.search(x, username)
-    ]:
-        raise e
-    for e in [
-        validators.ValidationError(f"Username must not follow custom pattern /{x}/")
-        for x in config.config.username["invalidation_regex"]
-        if re.search(x, username)
-    ]:
-        raise e
+    error = config.config.username_rules.check(username.data)
+    if error:
+        raise validators.ValidationError(error)
 
 
 def validate_password(form, password):
@@ -104,12 +124,19 @@ def validate_password(form, password):
     Raises
     -------
     ValidationError
-        Password doesn't follow length requirements
+        Password doesn't follow length requirements or is breached
     """
     min_length = config.config.password["min_length"]
     err = "Password should be between %s and 255 chars long" % min_length
     if len(password.data) < min_length or len(password.data) > 255:
         raise validators.ValidationError(err)
+    breached_hashes = config.config.breached_hashes
+    if breached_hashes is not None:
+        digest = hashlib.sha1(password.data.encode("utf8")).digest()
+        if digest in breached_hashes:
+            raise validators.ValidationError(
+                "Password is known from a data breach, please choose another one"
+            )
 
 
 class RegistrationForm(Form):
@@ -169,13 +196,30 @@ def unauthorized():
 
 @api.route("/static/replace/images/element-logo.png")
 def element_logo():
-    return send_file(
-        config.config.client_logo.replace("{cwd}", f"{os.getcwd()}/"),
-        mimetype="image/jpeg",
-    )
+    logo = get_client_logo()
+    if logo is None:
+        abort(404)
+    if request.args.get("v") == logo.fingerprint:
+        return logo.make_response(IMMUTABLE)
+    return logo.make_response(REVALIDATE)
+
+
+def get_client_logo():
+    """
+    returns the configured client logo or None, it is read once per config
+    """
+    path = config.config.client_logo.replace("{cwd}", f"{os.getcwd()}/")
+    try:
+        return load_asset(
+            os.path.join(current_app.root_path, path), config.config.generation
+        )
+    except OSError as e:
+        logger.error("could not read the client logo: %s" % e)
+        return None
 
 
 @api.route("/register", methods=["GET", "POST"])
+@limiter.limit(get_default_rate_limit, methods=["GET"])
 def register():
     """
     main user account registration endpoint
@@ -188,23 +232,26 @@ def register():
     as described in the RegistrationForm
     """
     if request.method == "POST":
-        logger.debug("an account registration started...")
-        form = RegistrationForm(request.form)
-        logger.debug("validating request data...")
-        if form.validate():
-            logger.debug("request valid")
-            return create_account_from_form(form)
-
-        logger.debug("account creation failed!")
-        resp = {"errcode": "MR_BAD_USER_REQUEST", "error": form.errors}
-        return make_response(jsonify(resp), 400)
+        form, lease = start_registration()
+        return create_account_from_form(form, lease)
 
     # GET REQUEST
+    lang = negotiate(request.args.get("lang"), *request.accept_languages.values())
+    page = cached_page((request.script_root, lang), lambda: render_register(lang))
+    return page.make_response(
+        config.config.page_cache["cache_control"], vary=("Accept-Language",)
+    )
+
+
+def render_register(lang):
+    """
+    renders the registration page, it only depends on the config and the
+    language, so it is cached by register()
+    """
     server_name = config.config.server_name
     pw_length = config.config.password["min_length"]
     uname_regex = config.config.username["validation_regex"]
     uname_regex_inv = config.config.username["invalidation_regex"]
-    lang = request.args.get("lang") or request.accept_languages.best
     replacements = {"server_name": server_name, "pw_length": pw_length}
     translations = get_translations(lang, replacements)
     return render_template(
@@ -213,33 +260,200 @@ def register():
         pw_length=pw_length,
         uname_regex=uname_regex,
         uname_regex_inv=uname_regex_inv,
+        check_availability=config.config.username["check_availability"],
         client_redirect=config.config.client_redirect,
+        client_logo_url=client_logo_url(),
         base_url=config.config.base_url,
         translations=translations,
     )
 
 
-def create_account_from_form(form):
-    # remove sigil and the domain from the username
-    username = form.username.data.rsplit(":")[0].split("@")[-1]
-    logger.debug("creating account %s..." % username)
+def client_logo_url():
+    logo = get_client_logo()
+    if logo is None:
+        return url_for("api.element_logo")
+    # the version makes the url change with the logo, so it can be cached
+    return url_for("api.element_logo", v=logo.fingerprint)
+
+
+@api.route("/register/available")
+@limiter.limit(get_username_check_rate_limit)
+def register_available():
+    """
+    checks if a username can still be registered
+    to check a username send a GET request with
+      - username
+    as query parameter, answers are cached for a while, so this can be
+    called while the user types
+    """
+    form = RegistrationForm(data={"username": request.args.get("username", "")})
+    if not form.username.validate(form):
+        resp = {
+            "errcode": "MR_BAD_USER_REQUEST",
+            "error": {"username": form.username.errors},
+        }
+        return make_response(jsonify(resp), 400)
+    username = get_localpart(form.username.data)
+    available = None
+    if config.config.username["check_availability"]:
+        available = username_available(
+            username, config.config.server_location, config.config.admin_access_token
+        )
+    return jsonify(username=username, available=available)
+
+
+def start_registration():
+    """
+    validates a registration request and reserves a usage of its token
+
+    aborts with an error response if the request is invalid
+
+    Returns
+    -------
+    tuple
+        the validated RegistrationForm and the id of the token lease
+    """
+    logger.debug("an account registration started...")
+    attempts.check()
+    form = RegistrationForm(request.form)
+    logger.debug("validating request data...")
+    if not form.validate():
+        logger.debug("account creation failed!")
+        # wrong tokens cost more, so guessing them is throttled quickly
+        attempts.charge(invalid_token_cost() if "token" in form.errors else 1)
+        resp = {"errcode": "MR_BAD_USER_REQUEST", "error": form.errors}
+        abort(make_response(jsonify(resp), 400))
+    logger.debug("request valid")
+    attempts.charge()
+    registrations.check()
+    # hold one usage of the token while the hs creates the account, so
+    # parallel registrations can't exceed its max_usage
+    lease = tokens.tokens.reserve(form.token.data)
+    if lease is None:
+        # the token was used up in the meantime
+        attempts.charge(invalid_token_cost() - 1)
+        resp = {
+            "errcode": "MR_BAD_USER_REQUEST",
+            "error": {"token": ["Token is invalid"]},
+        }
+        abort(make_response(jsonify(resp), 400))
+    registrations.charge()
+    return form, lease
+
+
+def invalid_token_cost():
+    return config.config.rate_limits["invalid_token_cost"]
+
+
+def get_localpart(username):
+    """
+    removes sigil and the domain from the username
+    """
+    return username.rsplit(":")[0].split("@")[-1]
+
+
+def check_username(username):
+    """
+    asks the homeserver if the username is still available
+
+    Parameters
+    ----------
+    arg1 : str
+        local part of the username
+
+    Raises
+    -------
+    UsernameTaken
+        the homeserver knows the username is taken
+    """
+    if not config.config.username["check_availability"]:
+        return
+    available = username_available(
+        username, config.config.server_location, config.config.admin_access_token
+    )
+    if available is False:
+        raise UsernameTaken("@%s:%s" % (username, config.config.server_name))
+
+
+def account_request(form):
+    """
+    returns the arguments for create_account
+
+    Parameters
+    ----------
+    arg1 : RegistrationForm
+        validated form
+    """
+    return (
+        form.username.data,
+        form.password.data,
+        config.config.server_location,
+        config.config.registration_shared_secret,
+    )
+
+
+def create_account_from_form(form, lease):
+    logger.debug("creating account %s..." % form.username.data)
+    args = account_request(form)
     # send account creation request to the hs
     try:
-        account_data = create_account(
-            form.username.data,
-            form.password.data,
-            config.config.server_location,
-            config.config.registration_shared_secret,
-        )
-    except exceptions.ConnectionError:
+        # names that are known to be taken aren't sent to the homeserver
+        check_username(get_localpart(form.username.data))
+        with get_admission_control(config.config.server_location).admitted():
+            account_data = create_account(*args)
+    except (
+        UsernameTaken,
+        HomeserverUnavailable,
+        exceptions.RequestException,
+    ) as e:
+        return registration_failed(form, lease, e)
+    return registration_succeeded(form, lease, account_data)
+
+
+def registration_failed(form, lease, error):
+    """
+    gives the reserved token usage back and turns the error of the
+    homeserver request into a response
+
+    Parameters
+    ----------
+    arg1 : RegistrationForm
+    arg2 : str
+        id of the token lease
+    arg3 : Exception
+        UsernameTaken, HomeserverUnavailable or a RequestException
+    """
+    tokens.tokens.release(lease, form.token.data)
+    if isinstance(error, UsernameTaken):
+        resp = {"errcode": "M_USER_IN_USE", "error": "User ID already taken."}
+        return make_response(jsonify(resp), 400)
+    if isinstance(error, HomeserverBusy):
+        resp = {
+            "errcode": "MR_HS_BUSY",
+            "error": "too many registrations at the moment, try again later",
+        }
+        resp = make_response(jsonify(resp), 503)
+        resp.headers["Retry-After"] = str(error.retry_after)
+        return resp
+    if isinstance(error, HomeserverUnavailable):
+        resp = {
+            "errcode": "MR_HS_UNAVAILABLE",
+            "error": "homeserver is unavailable, try again later",
+        }
+        resp = make_response(jsonify(resp), 503)
+        resp.headers["Retry-After"] = str(error.retry_after)
+        return resp
+    if isinstance(error, exceptions.Timeout):
+        logger.error("%s timed out" % config.config.server_location)
+        abort(504)
+    if isinstance(error, exceptions.ConnectionError):
         logger.error(
             "can not connect to %s" % config.config.server_location,
-            exc_info=True,
+            exc_info=error,
         )
         abort(500)
-    except exceptions.HTTPError as e:
-        resp = e.response
-        error = resp.json()
+    if isinstance(error, exceptions.HTTPError):
+        resp = error.response
         status_code = resp.status_code
         if status_code == 404:
             logger.error("no HS found at %s" % config.config.server_location)
@@ -248,14 +462,37 @@ def create_account_from_form(form):
         elif status_code == 400:
             # most likely this should only be triggered if a userid
             # is already in use
-            return make_response(jsonify(error), 400)
+            return make_response(jsonify(resp.json()), 400)
         else:
-            logger.error("failure communicating with HS", exc_info=True)
+            logger.error("failure communicating with HS", exc_info=error)
         abort(500)
+    logger.error("failure communicating with HS", exc_info=error)
+    abort(500)
 
+
+def registration_succeeded(form, lease, account_data):
+    """
+    uses the reserved token usage and returns the account of the new user
+
+    Parameters
+    ----------
+    arg1 : RegistrationForm
+    arg2 : str
+        id of the token lease
+    arg3 : dict
+        account data returned by the registration backend
+    """
     logger.debug("using token %s" % form.token.data)
-    ips = ", ".join(get_request_ips(request)) if config.config.ip_logging else False
-    tokens.tokens.use(form.token.data, ips)
+    ips = get_request_ips(request) if config.config.ip_logging else False
+    if not tokens.tokens.confirm(lease, form.token.data, ips):
+        # the account exists already, so the registration still succeeded
+        logger.error(
+            "lease %s expired and token %s was used up in the meantime, "
+            "account %s was created without a usage of it"
+            % (lease, form.token.data, form.username.data)
+        )
+    if config.config.username["check_availability"]:
+        get_username_cache().set(get_localpart(form.username.data), False)
 
     logger.debug("account creation succeded!")
     return jsonify(
@@ -274,8 +511,56 @@ def get_token(token):
     return make_response(jsonify(resp), 404)
 
 
+def parse_bool(value):
+    if value.lower() in ("1", "true", "yes"):
+        return True
+    if value.lower() in ("0", "false", "no"):
+        return False
+    raise ValueError("%s is not a boolean" % value)
+
+
 def get_tokens():
-    return jsonify(tokens.tokens.toList())
+    """
+    lists tokens
+
+    without query parameters all tokens are returned, otherwise they can be
+    paginated with `after` and `limit` and filtered with `active`, `expired`,
+    `disabled`, `used_gt` and `prefix`. If there might be more tokens a
+    `Link` header with the url of the next page is set.
+    """
+    args = request.args
+    if not args:
+        return jsonify(tokens.tokens.toList())
+
+    try:
+        filters = {
+            key: parse_bool(args[key])
+            for key in ("active", "expired", "disabled")
+            if key in args
+        }
+        if "used_gt" in args:
+            filters["used_gt"] = int(args["used_gt"])
+        limit = int(args.get("limit", DEFAULT_TOKEN_PAGE))
+        if not 0 < limit <= MAX_TOKEN_PAGE:
+            raise ValueError("limit out of range")
+    except ValueError:
+        resp = {
+            "errcode": "MR_BAD_USER_REQUEST",
+            "error": "malformed query parameters",
+        }
+        return make_response(jsonify(resp), 400)
+
+    page = tokens.tokens.query(
+        after=args.get("after"), limit=limit, prefix=args.get("prefix"), **filters
+    )
+    resp = jsonify([token.toDict() for token in page])
+    if len(page) == limit:
+        next_args = {**args.to_dict(), "after": page[-1].name}
+        resp.headers["Link"] = '<%s?%s>; rel="next"' % (
+            request.base_url,
+            urlencode(next_args),
+        )
+    return resp
 
 
 def create_token(data):
@@ -294,6 +579,8 @@ def create_token(data):
             expiration_date = datetime.fromisoformat(data["expiration_date"])
         if "max_usage" in data:
             max_usage = data["max_usage"]
+        if "count" in data:
+            return create_tokens(data["count"], expiration_date, max_usage)
         token = tokens.tokens.new(expiration_date=expiration_date, max_usage=max_usage)
     except ValueError:
         resp = {
@@ -304,6 +591,34 @@ def create_token(data):
     return jsonify(token.toDict())
 
 
+def create_tokens(count, expiration_date, max_usage):
+    """
+    creates `count` tokens at once and streams them back as
+    newline delimited json or, if requested via the accept header, as csv
+    """
+    if type(count) is not int or not 0 < count <= tokens.MAX_TOKEN_BATCH:
+        resp = {
+            "errcode": "MR_BAD_USER_REQUEST",
+            "error": "count has to be between 1 and %s" % tokens.MAX_TOKEN_BATCH,
+        }
+        return make_response(jsonify(resp), 400)
+    if type(max_usage) not in (bool, int) or max_usage < 0:
+        resp = {
+            "errcode": "MR_BAD_USER_REQUEST",
+            "error": "max_usage has to be a non-negative integer",
+        }
+        return make_response(jsonify(resp), 400)
+
+    created = tokens.tokens.new_batch(
+        count, expiration_date=expiration_date, max_usage=max_usage
+    )
+    mimetype = request.accept_mimetypes.best_match(
+        ["application/x-ndjson", "text/csv"], default="application/x-ndjson"
+    )
+    fmt = "csv" if mimetype == "text/csv" else "ndjson"
+    return Response(tokens.serialize_tokens(created, fmt), mimetype=mimetype)
+
+
 def update_token(token, data):
     if "ips" in data or "active" in data or "name" in data:
         resp = {
@@ -347,10 +662,31 @@ def version():
         return make_response(jsonify(resp), 200)
 
 
+@api.route("/api/stats")
+@auth.login_required
+def stats():
+    misses = tokens.tokens.misses
+    resp = {
+        "tokens": {
+            "total": tokens.tokens.count(),
+            "active": tokens.tokens.count(active=True),
+        },
+        "token_misses": {
+            "total": sum(misses.values()),
+            "clients": {
+                str(client): count for client, count in misses.most_common(100)
+            },
+        },
+        "homeservers": {
+            location: breaker.state for location, breaker in _breakers.items()
+        },
+    }
+    return make_response(jsonify(resp), 200)
+
+
 @api.route("/api/token", methods=["GET", "POST"])
 @auth.login_required
 def token():
-    tokens.tokens.load()
     if request.method == "GET":
         return get_tokens()
     elif request.method == "POST":
@@ -363,7 +699,6 @@ def token():
 @api.route("/api/token/<token>", methods=["GET", "PATCH", "DELETE"])
 @auth.login_required
 def token_status(token):
-    tokens.tokens.load()
     data = False
     if request.method == "GET":
         return get_token(token)
@@ -9,15 +9,20 @@ from flask.cli import FlaskGroup, pass_script_info
 from flask_cors import CORS
 from waitress import serve
 
+from . import assets
 from . import config
 from . import tokens
-from .limiter import limiter
+from . import limiter
+from .sortedfile import write_hash_file
+from .translation import load_catalogs
 from .tokens import db
 
 
 def create_app(testing=False):
-    app = Flask(__name__)
+    # the static files are served by assets, with fingerprinted urls
+    app = Flask(__name__, static_folder=None)
     app.testing = testing
+    assets.init_app(app)
 
     with app.app_context():
         from .api import api, healthcheck
@@ -25,7 +30,11 @@ def create_app(testing=False):
         app.register_blueprint(api)
         app.register_blueprint(healthcheck)
 
-    limiter.init_app(app)
+    # the cli creates the app before it loads the config, see cli
+    if config.config is not None:
+        limiter.init_app(app)
+    # parse the translations before the first page view
+    load_catalogs()
     return app
 
 
@@ -42,6 +51,8 @@ def cli(info, config_path):
     config.config = config.Config(path=config_path)
     logging.config.dictConfig(config.config.logging)
     app = info.load_app()
+    if not app.extensions.get("limiter"):
+        limiter.init_app(app)
     with app.app_context():
         app.config.from_mapping(
             SQLALCHEMY_DATABASE_URI=config.config.db.format(cwd=f"{os.getcwd()}"),
@@ -66,6 +77,28 @@ def run_server(info):
     )
 
 
+@cli.command("serve-asgi", help="start asgi server, registers accounts on asyncio")
+@pass_script_info
+def run_asgi_server(info):
+    try:
+        import uvicorn
+        from .asgi import RegistrationApp
+    except ImportError as e:
+        raise click.ClickException(
+            "%s, install matrix-registration[asgi] to use the asgi server" % e
+        )
+    app = info.load_app()
+    if config.config.allow_cors:
+        CORS(app)
+    uvicorn.run(
+        RegistrationApp(app),
+        host=config.config.host,
+        port=config.config.port,
+        root_path=config.config.base_url,
+        log_config=None,
+    )
+
+
 @cli.command("generate", help="generate new token")
 @click.option("-m", "--maximum", default=0, help="times token can be used")
 @click.option(
@@ -75,16 +108,91 @@ def run_server(info):
     default=None,
     help="expire date: in ISO-8601 format (YYYY-MM-DD)",
 )
-def generate_token(maximum, expires):
-    token = tokens.tokens.new(expiration_date=expires, max_usage=maximum)
-    print(token.name)
+@click.option(
+    "-c",
+    "--count",
+    type=click.IntRange(1, tokens.MAX_TOKEN_BATCH),
+    default=1,
+    help="number of tokens to generate",
+)
+@click.option(
+    "-f",
+    "--format",
+    "fmt",
+    type=click.Choice(["plain", "ndjson", "csv"]),
+    default="plain",
+    help="output format",
+)
+def generate_token(maximum, expires, count, fmt):
+    if count == 1 and fmt == "plain":
+        token = tokens.tokens.new(expiration_date=expires, max_usage=maximum)
+        print(token.name)
+        return
+    created = tokens.tokens.new_batch(count, expiration_date=expires, max_usage=maximum)
+    for line in tokens.serialize_tokens(created, fmt):
+        print(line, end="")
+
+
+@cli.command("blocklist", help="prepare a username blocklist file")
+@click.argument("source", type=click.File("r", encoding="utf8"))
+@click.argument("target", type=click.Path(dir_okay=False, writable=True))
+def build_blocklist(source, target):
+    """
+    normalizes and sorts reserved usernames, so the file can be used as
+    username.blocklist_file
+    """
+    names = {config.normalize_username(line.strip()) for line in source}
+    names.discard("")
+    with open(target, "wb") as f:
+        for name in sorted(name.encode("utf8") for name in names):
+            f.write(name + b"\n")
+    print(f"{len(names)} usernames written to {target}")
+
+
+@cli.command("breached-hashes", help="prepare a breached password hash file")
+@click.argument("source", type=click.File("r"))
+@click.argument("target", type=click.Path(dir_okay=False, writable=True))
+@click.option(
+    "-p",
+    "--prefix-length",
+    default=20,
+    type=click.IntRange(1, 20),
+    help="bytes kept of every sha-1 hash",
+)
+def build_breached_hashes(source, target, prefix_length):
+    """
+    converts a text dump of sha-1 hashes, like the one of Have I Been
+    Pwned ordered by hash, into a file for password.breached_hashes_file
+    """
+    try:
+        count = write_hash_file(source, target, prefix_length)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"{count} hashes written to {target}")
+
+
+@cli.command("compress-static", help="precompress the static files")
+@click.argument(
+    "directory",
+    default=assets.STATIC_DIR,
+    type=click.Path(exists=True, file_okay=False, writable=True),
+)
+def compress_static(directory):
+    """
+    writes gzip and brotli variants next to the static files, so they
+    aren't compressed on every start, or can be served by a reverse proxy
+    """
+    count = assets.write_compressed(directory)
+    print(f"{count} compressed files written to {directory}")
 
 
 @cli.command("status", help="view status or disable")
 @click.option("-s", "--status", default=None, help="token status")
 @click.option("-l", "--list", is_flag=True, help="list tokens")
 @click.option("-d", "--disable", default=None, help="disable token")
-def status_token(status, list, disable):
+@click.option("-a", "--active", is_flag=True, help="only list active tokens")
+@click.option("-c", "--count", is_flag=True, help="count tokens")
+def status_token(status, list, disable, active, count):
     if disable:
         if tokens.tokens.disable(disable):
             print("Token disabled")
@@ -97,5 +205,11 @@ def status_token(status, list, disable):
             print(json.dumps(token.toDict(), indent=2))
         else:
             print("No token with that name")
+    elif list and active:
+        print(", ".join(tokens.tokens.names(active=True)))
     elif list:
         print(tokens.tokens)
+    elif count:
+        print(
+            f"{tokens.tokens.count()} tokens, {tokens.tokens.count(active=True)} active"
+        )
@@ -0,0 +1,304 @@
+"""
+asgi entry point
+
+account registrations are handled on the event loop and talk to the
+homeserver with an async http client, so slow homeservers only cost a
+coroutine per signup instead of a server thread. The short token store
+queries run in a thread pool. Every other request is passed on to the
+flask app.
+
+needs the optional dependencies from the "asgi" extra
+"""
+# Standard library imports...
+import asyncio
+import io
+import logging
+import sys
+
+# Third-party imports...
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.exceptions import HTTPException
+
+# Local imports...
+from . import api
+from . import config
+from .matrix_api import (
+    FetchNonce,
+    Sleep,
+    UsernameTaken,
+    create_account_plan,
+    get_admission_control,
+    nonce_plan,
+    username_available_plan,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def _run(client, plan):
+    """
+    carries out a plan of matrix_api with an async http client
+
+    httpx errors are thrown into the plan as the matching requests
+    exceptions, so they are handled like the ones of matrix_api._run.
+
+    Parameters
+    ----------
+    arg1 : httpx.AsyncClient
+        client for the homeserver
+    arg2 : generator
+        plan, e.g. from matrix_api.create_account_plan
+    """
+    value = error = None
+    while True:
+        try:
+            step = plan.send(value) if error is None else plan.throw(error)
+        except StopIteration as e:
+            return e.value
+        value = error = None
+        try:
+            if isinstance(step, Sleep):
+                await asyncio.sleep(step.seconds)
+            elif isinstance(step, FetchNonce):
+                value = await _run(client, nonce_plan(step.server_location))
+            else:
+                value = await _send(client, step)
+        except BaseException as e:
+            # also cancellations, so the plan can clean up before raising it
+            error = e
+
+
+async def _send(client, call):
+    options = config.config.homeserver
+    timeout = httpx.Timeout(options["read_timeout"], connect=options["connect_timeout"])
+    try:
+        return await client.request(
+            call.method.upper(),
+            "%s%s" % (call.server_location, call.path),
+            timeout=timeout,
+            **call.kwargs,
+        )
+    except httpx.TimeoutException as e:
+        raise requests.exceptions.Timeout(str(e))
+    except httpx.TransportError as e:
+        raise requests.exceptions.ConnectionError(str(e))
+
+
+async def create_account(
+    client, user, password, server_location, shared_secret, admin=False, user_type=None
+):
+    """
+    creates account, see matrix_api.create_account
+
+    Parameters
+    ----------
+    arg1 : httpx.AsyncClient
+        client for the homeserver
+    """
+    return await _run(
+        client,
+        create_account_plan(
+            user, password, server_location, shared_secret, admin, user_type
+        ),
+    )
+
+
+async def username_available(client, user, server_location, access_token=None):
+    """
+    checks with the homeserver if a username is available, see
+    matrix_api.username_available
+    """
+    return await _run(
+        client, username_available_plan(user, server_location, access_token)
+    )
+
+
+def build_environ(scope, body):
+    """
+    builds the wsgi environ of an asgi http request
+
+    Parameters
+    ----------
+    arg1 : dict
+        asgi scope
+    arg2 : bytes
+        request body
+    """
+    script_name = scope.get("root_path", "")
+    path_info = scope["path"]
+    if script_name and path_info.startswith(script_name):
+        path_info = path_info[len(script_name) :]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name.encode("utf8").decode("latin1"),
+        "PATH_INFO": path_info.encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope["http_version"],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        if name not in ("CONTENT_LENGTH", "CONTENT_TYPE"):
+            name = "HTTP_%s" % name
+        value = value.decode("latin1")
+        if name in environ:
+            value = "%s,%s" % (environ[name], value)
+        environ[name] = value
+    return environ
+
+
+class RegistrationApp:
+    """
+    asgi application registering accounts on the event loop
+
+    POST requests to /register are validated, and their token reserved,
+    by the same code as in the flask app. Only the requests to the
+    homeserver are made asynchronously. Everything else is handled by the
+    flask app in a thread pool.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+        self.client = None
+
+    def get_client(self):
+        if self.client is None:
+            pool_size = config.config.homeserver["pool_size"]
+            self.client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=None, max_keepalive_connections=pool_size
+                ),
+                headers=None
+                if config.config.homeserver["keep_alive"]
+                else {"Connection": "close"},
+            )
+        return self.client
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path) :]
+        if scope["type"] == "http" and scope["method"] == "POST" and path == "/register":
+            return await self.register(scope, receive, send)
+        return await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.client is not None:
+                    await self.client.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def register(self, scope, receive, send):
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        environ = build_environ(scope, body)
+
+        started = await sync_to_async(self.dispatch, thread_sensitive=False)(
+            environ, self.start
+        )
+        if not isinstance(started, tuple):
+            return await self.respond(send, started)
+        form, lease, args = started
+
+        logger.debug("creating account %s..." % form.username.data)
+        admission = get_admission_control(config.config.server_location)
+        try:
+            await self.check_username(api.get_localpart(form.username.data))
+            async with admission.admitted_async():
+                account_data = await create_account(self.get_client(), *args)
+        except Exception as e:
+            response = await sync_to_async(self.dispatch, thread_sensitive=False)(
+                environ, api.registration_failed, form, lease, e
+            )
+        else:
+            response = await sync_to_async(self.dispatch, thread_sensitive=False)(
+                environ, api.registration_succeeded, form, lease, account_data
+            )
+        await self.respond(send, response)
+
+    async def check_username(self, username):
+        """
+        raises UsernameTaken if the homeserver knows the username is taken
+        """
+        if not config.config.username["check_availability"]:
+            return
+        available = await username_available(
+            self.get_client(),
+            username,
+            config.config.server_location,
+            config.config.admin_access_token,
+        )
+        if available is False:
+            raise UsernameTaken("@%s:%s" % (username, config.config.server_name))
+
+    def start(self):
+        """
+        runs the before request hooks, e.g. the rate limits, and reserves
+        the token
+        """
+        rv = self.app.preprocess_request()
+        if rv is not None:
+            return rv
+        form, lease = api.start_registration()
+        return form, lease, api.account_request(form)
+
+    def dispatch(self, environ, view, *args):
+        """
+        calls a view in a request context of the flask app
+
+        returns the finished response, or the return value of the view if
+        it is a tuple
+        """
+        with self.app.request_context(environ):
+            try:
+                rv = view(*args)
+            except HTTPException as e:
+                rv = self.app.handle_user_exception(e)
+            except Exception as e:
+                rv = self.app.handle_exception(e)
+            if isinstance(rv, tuple):
+                return rv
+            response = self.app.make_response(rv)
+            return self.app.process_response(response)
+
+    async def respond(self, send, response):
+        headers = [
+            (k.lower().encode("latin1"), v.encode("latin1"))
+            for k, v in response.headers.items()
+        ]
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": headers,
+            }
+        )
+        await send({"type": "http.response.body", "body": response.get_data()})
+
@@ -0,0 +1,177 @@
+# Standard library imports...
+import functools
+import hashlib
+import logging
+import mimetypes
+import os
+
+# Third-party imports...
+from flask import abort, current_app
+
+# Local imports...
+from .caching import CachedResponse, brotli, compress
+from .constants import __location__
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.join(__location__, "static")
+# fingerprinted urls change with the content, so they can be cached forever
+IMMUTABLE = "public, max-age=31536000, immutable"
+# everything else has to be revalidated with the etag
+REVALIDATE = "no-cache"
+# content codings of the precompressed files next to the assets
+PRECOMPRESSED = {"br": ".br", "gzip": ".gz"}
+# formats that are compressed already, like images and fonts, are left out
+COMPRESSIBLE = {
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+    "image/vnd.microsoft.icon",
+    "image/x-icon",
+    "text/css",
+    "text/javascript",
+    "text/plain",
+}
+
+mimetypes.add_type("font/woff2", ".woff2")
+
+
+def guess_mimetype(path):
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+class Asset(CachedResponse):
+    """
+    static file kept in memory together with its compressed variants
+
+    variants written next to the file, e.g. style.css.gz, are used as they
+    are. Without any, the file is compressed on load.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            data = f.read()
+        mimetype = guess_mimetype(path)
+        variants = {}
+        if mimetype in COMPRESSIBLE:
+            mtime = os.path.getmtime(path)
+            for coding, suffix in PRECOMPRESSED.items():
+                compressed = path + suffix
+                if os.path.isfile(compressed) and os.path.getmtime(compressed) >= mtime:
+                    with open(compressed, "rb") as f:
+                        variants[coding] = f.read()
+            if not variants:
+                variants = compress(data)
+        super().__init__(data, mimetype, variants)
+        self.fingerprint = hashlib.sha256(data).hexdigest()[:12]
+
+
+class Assets:
+    """
+    content-hashed static files
+
+    every file is also available under a name with the hash of its
+    content, e.g. css/style.0123456789ab.css, which is what url_for
+    returns. The plain names keep working for old links.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+        self.fingerprinted = {}
+        self.urls = {}
+        for root, dirs, filenames in os.walk(directory):
+            for filename in filenames:
+                if os.path.splitext(filename)[1] in PRECOMPRESSED.values():
+                    continue
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, directory).replace(os.sep, "/")
+                asset = Asset(path)
+                base, ext = os.path.splitext(name)
+                url = "%s.%s%s" % (base, asset.fingerprint, ext)
+                self.files[name] = asset
+                self.fingerprinted[url] = asset
+                self.urls[name] = url
+        logger.debug("loaded %s static files from %s" % (len(self.files), directory))
+
+    def url_defaults(self, endpoint, values):
+        """
+        replaces file names with their fingerprinted ones in url_for
+        """
+        if endpoint == "static" and values.get("filename") in self.urls:
+            values["filename"] = self.urls[values["filename"]]
+
+    def serve(self, filename):
+        asset = self.fingerprinted.get(filename)
+        if asset is not None:
+            return asset.make_response(IMMUTABLE)
+        asset = self.files.get(filename)
+        if asset is None:
+            abort(404)
+        return asset.make_response(REVALIDATE)
+
+
+def init_app(app, directory=STATIC_DIR):
+    """
+    serves the static files of the app from memory
+
+    Parameters
+    ----------
+    arg1 : Flask
+        app created without a static folder
+    arg2 : str
+        directory with the static files
+    """
+    assets = Assets(directory)
+    app.extensions["assets"] = assets
+    app.url_defaults(assets.url_defaults)
+    app.add_url_rule("/static/<path:filename>", endpoint="static", view_func=serve)
+
+
+def serve(filename):
+    return current_app.extensions["assets"].serve(filename)
+
+
+@functools.lru_cache(maxsize=4)
+def load_asset(path, generation):
+    """
+    loads a file outside of the static directory, e.g. the client logo,
+    once per config generation
+    """
+    return Asset(path)
+
+
+def write_compressed(directory):
+    """
+    writes compressed variants next to the compressible files
+
+    brotli variants need the optional brotli package.
+
+    Parameters
+    ----------
+    arg1 : str
+        directory with the static files
+
+    Returns
+    -------
+    int
+        number of files written
+    """
+    count = 0
+    for root, dirs, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if os.path.splitext(filename)[1] in PRECOMPRESSED.values():
+                continue
+            if guess_mimetype(path) not in COMPRESSIBLE:
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            for coding, compressed in compress(data).items():
+                with open(path + PRECOMPRESSED[coding], "wb") as f:
+                    f.write(compressed)
+                count += 1
+    if brotli is None:
+        logger.warning("brotli is not installed, only gzip variants were written")
+    return count
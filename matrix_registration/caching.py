@@ -0,0 +1,142 @@
+# Standard library imports...
+import gzip
+import hashlib
+import logging
+import threading
+
+# Third-party imports...
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Local imports...
+from . import config
+
+logger = logging.getLogger(__name__)
+
+# smaller bodies don't get any smaller by compressing them
+MIN_COMPRESS_SIZE = 256
+
+_pages = {}
+_pages_generation = None
+_pages_lock = threading.Lock()
+
+
+def compress(data):
+    """
+    returns the compressed variants of data by content coding
+
+    brotli is only used if the optional brotli package is installed,
+    variants that aren't smaller than data are left out.
+
+    Parameters
+    ----------
+    arg1 : bytes
+        uncompressed data
+    """
+    variants = {}
+    if len(data) < MIN_COMPRESS_SIZE:
+        return variants
+    if brotli is not None:
+        variants["br"] = brotli.compress(data, quality=11)
+    variants["gzip"] = gzip.compress(data, compresslevel=9, mtime=0)
+    return {k: v for k, v in variants.items() if len(v) < len(data)}
+
+
+class CachedResponse:
+    """
+    response body that is built once and served from memory
+
+    every content coding gets its own strong etag, so caches never mix up
+    the compressed and uncompressed body.
+    """
+
+    def __init__(self, data, mimetype, variants=None):
+        self.mimetype = mimetype
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        self.bodies = {"identity": data}
+        self.bodies.update(compress(data) if variants is None else variants)
+        self.etags = {
+            coding: digest if coding == "identity" else "%s-%s" % (digest, coding)
+            for coding in self.bodies
+        }
+
+    def choose(self, accept_encodings):
+        """
+        returns the content coding to send
+
+        Parameters
+        ----------
+        arg1 : werkzeug.datastructures.Accept
+            Accept-Encoding of the request
+        """
+        return max(
+            self.bodies,
+            key=lambda coding: (
+                1 if coding == "identity" else accept_encodings[coding],
+                -len(self.bodies[coding]),
+            ),
+        )
+
+    def make_response(self, cache_control, vary=()):
+        """
+        returns the response for the current request, 304 if the client
+        has it already
+
+        Parameters
+        ----------
+        arg1 : str
+            value of the Cache-Control header
+        arg2 : iterable
+            request headers the response depends on besides Accept-Encoding
+        """
+        coding = self.choose(request.accept_encodings)
+        if any(map(request.if_none_match.contains, self.etags.values())):
+            response = Response(status=304)
+        else:
+            response = Response(self.bodies[coding], mimetype=self.mimetype)
+            if coding != "identity":
+                response.headers["Content-Encoding"] = coding
+        response.set_etag(self.etags[coding])
+        if cache_control:
+            response.headers["Cache-Control"] = cache_control
+        response.vary.update(("Accept-Encoding",) + tuple(vary))
+        return response
+
+
+def cached_page(key, render, mimetype="text/html"):
+    """
+    returns a page rendered once per config
+
+    the pages are dropped whenever the config is loaded again.
+
+    Parameters
+    ----------
+    arg1 : hashable
+        everything the page depends on besides the config, e.g. its language
+    arg2 : callable
+        returns the page as a str
+    """
+    global _pages_generation
+    generation = config.config.generation
+    with _pages_lock:
+        if _pages_generation != generation:
+            _pages.clear()
+            _pages_generation = generation
+        page = _pages.get(key)
+    if page is not None:
+        return page
+    logger.debug("rendering page %s" % (key,))
+    data = render().encode("utf8")
+    page = CachedResponse(
+        data,
+        "%s; charset=utf-8" % mimetype,
+        variants=None if config.config.page_cache["compress"] else {},
+    )
+    with _pages_lock:
+        if _pages_generation == generation:
+            _pages[key] = page
+    return page
@@ -1,7 +1,10 @@
 # Standard library imports...
 # from collections import namedtuple
+import itertools
 import logging
+import math
 import os
+import re
 import sys
 
 # Third-party imports...
@@ -9,6 +12,7 @@ import yaml
 from jsonschema import validate, ValidationError
 
 # Local imports...
+from .sortedfile import HashFile, SortedFile
 from .constants import (
     CONFIG_SCHEMA_PATH,
     CONFIG_DIR1,
@@ -22,8 +26,243 @@ CONFIG_DIRS = [CONFIG_DIR1, CONFIG_DIR2, CONFIG_DIR3, CONFIG_DIR4, CONFIG_DIR5]
 
 CONFIG_SAMPLE_NAME = "config.sample.yaml"
 CONFIG_NAME = "config.yaml"
+# values for options that may be omitted from the config file
+CONFIG_DEFAULTS = {
+    "token_lease_ttl": None,
+    "token_cache_ttl": 1,
+    "token_name": {"length": 3, "wordlist": None},
+    "username": {
+        "check_availability": False,
+        "availability_ttl": 30,
+        "blocklist_file": None,
+    },
+    "password": {"breached_hashes_file": None},
+    "rate_limits": {
+        "registration": ["10 per hour"],
+        "username_check": ["60 per minute"],
+        "invalid_token_cost": 5,
+    },
+    "rate_limit_storage": {
+        "uri": "memory://",
+        "options": {},
+        "strategy": "fixed-window",
+        "fail_open": True,
+    },
+    "page_cache": {"cache_control": "public, max-age=300", "compress": True},
+    "admin_access_token": None,
+    "homeserver": {
+        "pool_size": 10,
+        "keep_alive": True,
+        "connect_timeout": 5,
+        "read_timeout": 30,
+        "nonce_retries": 2,
+        "nonce_pool_size": 0,
+        "nonce_ttl": 50,
+        "retry_backoff": 0.2,
+        "failure_threshold": 5,
+        "reset_timeout": 30,
+        "max_concurrent": 0,
+        "queue_size": 100,
+        "queue_timeout": 10,
+        "target_latency": None,
+        "balancing": "least_outstanding",
+    },
+}
 logger = logging.getLogger(__name__)
 
+# invalidation patterns that are just a name
+RE_LITERAL = re.compile(r"^[a-zA-Z0-9_=/-]+$")
+RE_ANCHORED_LITERAL = re.compile(r"^\^([a-zA-Z0-9_=/-]+)\$$")
+# characters that look alike are folded into one, separators are dropped.
+# 1, l and i all become i, so that each of them matches the others
+CONFUSABLES = str.maketrans("01345il7", "oieasiit", "_-=./")
+# patterns with backreferences or inline flags
+RE_UNMERGEABLE = re.compile(r"\\\d|\(\?P=|\(\?[aiLmsux]+\)")
+# seconds a lease outlives the longest homeserver request, for the token store
+LEASE_MARGIN = 10
+# counts how often options were applied, to invalidate what was derived from them
+_generations = itertools.count(1)
+
+
+def with_defaults(options, defaults):
+    """
+    recursively fills in missing options from defaults
+
+    Parameters
+    ----------
+    arg1 : dict
+        options as read from the config
+    arg2 : dict
+        default values
+    """
+    merged = dict(options)
+    for k, v in defaults.items():
+        if k not in merged:
+            merged[k] = v
+        elif isinstance(v, dict) and isinstance(merged[k], dict):
+            merged[k] = with_defaults(merged[k], v)
+    return merged
+
+
+def registration_time(options, locations=1, check_availability=False):
+    """
+    returns the seconds a registration may spend waiting for the homeserver
+
+    a free slot is waited for up to queue_timeout, then every endpoint may
+    fail to hand out a nonce with all retries before the account is
+    created on the last one. Every request may take connect_timeout and
+    read_timeout, the backoff before retries is jittered by up to 50%.
+
+    Parameters
+    ----------
+    arg1 : dict
+        homeserver options
+    arg2 : int
+        number of server locations
+    arg3 : bool
+        if the username is checked before registering it
+    """
+    request = options["connect_timeout"] + options["read_timeout"]
+    retries = options["nonce_retries"]
+    nonce = (retries + 1) * request
+    nonce += 1.5 * options["retry_backoff"] * (2**retries - 1)
+    seconds = locations * nonce + request
+    if options["max_concurrent"]:
+        seconds += options["queue_timeout"]
+    if check_availability:
+        seconds += request
+    return seconds
+
+
+def trie_pattern(words):
+    """
+    returns a regex matching any of the words
+
+    the words are merged into a trie, so matching doesn't get slower with
+    the number of words. A word that starts with another word is left out,
+    as searching for the shorter one finds it already.
+
+    Parameters
+    ----------
+    arg1 : iterable
+        literal words
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        if "" in node:
+            return ""
+        alternatives = [re.escape(c) + build(child) for c, child in sorted(node.items())]
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return "(?:%s)" % "|".join(alternatives)
+
+    return build(trie)
+
+
+def normalize_username(username):
+    """
+    returns the form of a username used for the blocklist
+
+    usernames that only differ in case, separators or confusable
+    characters, like 'Admin', 'a_dmin', '4dmin' and 'adm1n', are the same.
+
+    Parameters
+    ----------
+    arg1 : str
+        local part of the username
+    """
+    return username.casefold().translate(CONFUSABLES).replace("rn", "m")
+
+
+class UsernameRules:
+    """
+    username requirements of the config, compiled once
+
+    names that must not be used are checked in one go: anchored names
+    like '^admin$' are looked up in a set, plain names like 'admin' are
+    searched for with a single trie regex and all other patterns are
+    merged into one alternation. Long lists of reserved names belong in
+    a blocklist file instead, see SortedFile.
+    """
+
+    def __init__(
+        self, server_name, validation_regex, invalidation_regex, blocklist_file=None
+    ):
+        self.blocklist = SortedFile(blocklist_file) if blocklist_file else None
+        self.mxid = re.compile(
+            r"^(?P<at>@)?(?P<username>[a-zA-Z_\-=\.\/0-9]+)"
+            r"(?P<server_name>:%s)?$" % re.escape(server_name)
+        )
+        self.validation = [(x, re.compile(x)) for x in validation_regex]
+
+        self.reserved = {}
+        self.words = {}
+        merged = []
+        # checked one by one, as backreferences and inline flags can't be merged
+        self.invalidation = []
+        for x in invalidation_regex:
+            anchored = RE_ANCHORED_LITERAL.match(x)
+            if anchored:
+                self.reserved.setdefault(anchored.group(1), x)
+            elif RE_LITERAL.match(x):
+                self.words.setdefault(x, x)
+            elif RE_UNMERGEABLE.search(x):
+                self.invalidation.append((x, re.compile(x)))
+            else:
+                merged.append((x, re.compile(x)))
+        self.words_re = re.compile(trie_pattern(self.words)) if self.words else None
+        self.merged = merged
+        self.merged_re = None
+        if merged:
+            try:
+                self.merged_re = re.compile("|".join("(?:%s)" % x for x, _ in merged))
+            except re.error:
+                # e.g. the same group name in two patterns
+                self.invalidation += merged
+                self.merged = []
+
+    def check(self, username):
+        """
+        returns why the username is invalid or None
+
+        Parameters
+        ----------
+        arg1 : str
+            username name, e.g: '@user:matrix.org' or 'user'
+        """
+        match = self.mxid.search(username)
+        if not match:
+            return f"Username doesn't follow mxid pattern: /{self.mxid.pattern}/"
+        username = match.group("username")
+        for x, pattern in self.validation:
+            if not pattern.search(username):
+                return f"Username does not follow custom pattern /{x}/"
+        x = self.reserved.get(username)
+        if x is None and self.words_re is not None:
+            match = self.words_re.search(username)
+            if match:
+                x = self.words[match.group(0)]
+        if x is None and self.merged_re and self.merged_re.search(username):
+            # find the pattern to report
+            x = next(x for x, pattern in self.merged if pattern.search(username))
+        if x is None:
+            x = next(
+                (x for x, pattern in self.invalidation if pattern.search(username)),
+                None,
+            )
+        if x is not None:
+            return f"Username must not follow custom pattern /{x}/"
+        if self.blocklist is not None:
+            if normalize_username(username).encode("utf8") in self.blocklist:
+                return "Username is reserved"
+        return None
+
 
 class Config:
     """
@@ -141,8 +380,54 @@ class Config:
         """
         logger.debug("applying options...")
         # recusively set dictionary to class properties
-        for k, v in self.data.items():
+        for k, v in with_defaults(self.data, CONFIG_DEFAULTS).items():
             setattr(self, k, v)
+        self.generation = next(_generations)
+        self.apply_lease_ttl()
+        try:
+            self.username_rules = UsernameRules(
+                self.server_name,
+                self.username["validation_regex"],
+                self.username["invalidation_regex"],
+                self.username["blocklist_file"],
+            )
+        except re.error as e:
+            sys.exit("invalid username regex in your config: %s" % e)
+        except IOError as e:
+            sys.exit("could not open the username blocklist: %s" % e)
+        if self.username["check_availability"] and not self.admin_access_token:
+            logger.warning(
+                "check_availability needs an admin_access_token if registration "
+                "is disabled on the homeserver, otherwise every check fails"
+            )
+        self.breached_hashes = None
+        if self.password["breached_hashes_file"]:
+            try:
+                self.breached_hashes = HashFile(self.password["breached_hashes_file"])
+            except (IOError, ValueError) as e:
+                sys.exit("could not open the breached password hashes: %s" % e)
+
+    def apply_lease_ttl(self):
+        """
+        makes sure leases outlive the registrations holding them
+
+        a lease that expires while the homeserver still creates the account
+        is reclaimed and its usage handed to someone else.
+        """
+        locations = self.server_location
+        seconds = registration_time(
+            self.homeserver,
+            len(locations) if isinstance(locations, list) else 1,
+            self.username["check_availability"],
+        )
+        if self.token_lease_ttl is None:
+            self.token_lease_ttl = math.ceil(seconds) + LEASE_MARGIN
+        elif self.token_lease_ttl <= seconds:
+            sys.exit(
+                "token_lease_ttl has to be longer than the %d seconds a registration "
+                "may take with your homeserver options, leave it out to derive it"
+                % math.ceil(seconds)
+            )
 
     def ask_for_options(self, sample_options):
         """
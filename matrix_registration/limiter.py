@@ -1,8 +1,18 @@
-from flask import request
-from flask_limiter import Limiter
+import logging
+import math
+import sys
+import time
+
+import flask_limiter
+from flask import abort, jsonify, make_response, request
+from flask_limiter.errors import RateLimitExceeded
+from limits import parse_many
+from limits.errors import ConfigurationError
 
 from . import config
 
+logger = logging.getLogger(__name__)
+
 
 def get_real_user_ip() -> str:
     """ratelimit the users original ip instead of (optional) reverse proxy"""
@@ -14,4 +24,145 @@ def get_default_rate_limit() -> str:
     return "; ".join(config.config.rate_limit)
 
 
+def get_registration_rate_limit() -> str:
+    """return limit_string of registrations reaching the homeserver"""
+    return "; ".join(config.config.rate_limits["registration"])
+
+
+def get_username_check_rate_limit() -> str:
+    """return limit_string of username availability checks"""
+    return "; ".join(config.config.rate_limits["username_check"])
+
+
+def storage_unavailable():
+    """
+    aborts with a 503, for when the limiter fails closed
+    """
+    logger.exception("rate limit storage unreachable, rejecting request")
+    resp = {
+        "errcode": "MR_RATE_LIMIT_UNAVAILABLE",
+        "error": "rate limiting is unavailable, try again later",
+    }
+    abort(make_response(jsonify(resp), 503))
+
+
+class Limiter(flask_limiter.Limiter):
+    """
+    limiter rejecting requests while its storage is unreachable, unless
+    rate_limit_storage.fail_open is set
+
+    flask-limiter has no public hook for storage errors, so this overrides
+    its private _check_request_limit. setup.py pins the tested versions.
+    """
+
+    def _check_request_limit(self, *args, **kwargs):
+        try:
+            super()._check_request_limit(*args, **kwargs)
+        except RateLimitExceeded:
+            raise
+        except Exception:
+            # only raised if errors aren't swallowed, i.e. the limiter fails closed
+            storage_unavailable()
+
+
+class Budget:
+    """
+    rate limit that is charged by the views themselves
+
+    unlike the limits of the decorators, a request can cost more or less
+    depending on how far it got, e.g. guessing tokens costs more than
+    mistyping a password. The counters are kept in the storage of the
+    limiter. limit_provider returns the limit string, like the one of
+    get_default_rate_limit.
+    """
+
+    def __init__(self, scope, limit_provider):
+        self.scope = scope
+        self.limit_provider = limit_provider
+
+    def check(self):
+        """
+        aborts with a 429 if the budget of the client is used up
+        """
+        key = get_real_user_ip()
+        try:
+            exceeded = [
+                limit
+                for limit in parse_many(self.limit_provider())
+                if not limiter.limiter.test(limit, key, self.scope)
+            ]
+            if not exceeded:
+                return
+            reset = max(
+                limiter.limiter.get_window_stats(limit, key, self.scope).reset_time
+                for limit in exceeded
+            )
+        except Exception:
+            self.storage_error()
+            return
+        logger.info("%s budget of %s exceeded" % (self.scope, key))
+        retry_after = max(math.ceil(reset - time.time()), 1)
+        resp = {
+            "errcode": "M_LIMIT_EXCEEDED",
+            "error": "Too many requests, try again later",
+            "retry_after_ms": retry_after * 1000,
+        }
+        response = make_response(jsonify(resp), 429)
+        response.headers["Retry-After"] = str(retry_after)
+        abort(response)
+
+    def charge(self, cost=1):
+        """
+        uses up part of the budget of the client
+
+        Parameters
+        ----------
+        arg1 : int
+            number of requests this one counts as
+        """
+        if cost < 1:
+            return
+        key = get_real_user_ip()
+        try:
+            for limit in parse_many(self.limit_provider()):
+                limiter.limiter.hit(limit, key, self.scope, cost=cost)
+        except Exception:
+            self.storage_error()
+
+    def storage_error(self):
+        if not config.config.rate_limit_storage["fail_open"]:
+            storage_unavailable()
+        logger.exception("rate limit storage unreachable, letting request through")
+
+
+def init_app(app):
+    """
+    sets up the limiter with the rate_limit_storage of the config
+
+    counters in a shared storage like redis apply to all workers and nodes
+    together, the default in-memory storage counts per process.
+
+    Parameters
+    ----------
+    arg1 : Flask
+        app to rate limit
+    """
+    options = config.config.rate_limit_storage
+    app.config.update(
+        RATELIMIT_STORAGE_URI=options["uri"],
+        RATELIMIT_STORAGE_OPTIONS=options["options"],
+        RATELIMIT_STRATEGY=options["strategy"],
+        RATELIMIT_SWALLOW_ERRORS=options["fail_open"],
+    )
+    # the limiter is shared by all apps, so forget the options of the last one,
+    # otherwise init_app keeps them over the app config (flask-limiter 4.x)
+    limiter._strategy = None
+    limiter._swallow_errors = None
+    limiter._storage_options = {}
+    try:
+        limiter.init_app(app)
+    except ConfigurationError as e:
+        sys.exit("invalid rate_limit_storage in your config: %s" % e)
+
+
 limiter = Limiter(key_func=get_real_user_ip)
@@ -1,41 +1,643 @@
 # Standard library imports...
+import asyncio
+import collections
+import contextlib
 import hashlib
 import hmac
+import logging
+import math
+import random
+import threading
+import time
+from urllib.parse import urlencode
+
+# Third-party imports...
 import requests
+from requests.adapters import HTTPAdapter
 
-import logging
+# Local imports...
+from . import config
 
 logger = logging.getLogger(__name__)
 
+_sessions = {}
+_sessions_lock = threading.Lock()
+_breakers = {}
+_breakers_lock = threading.Lock()
+_nonce_pools = {}
+_nonce_pools_lock = threading.Lock()
+_admission_controls = {}
+_admission_controls_lock = threading.Lock()
+_balancers = {}
+_balancers_lock = threading.Lock()
+_usernames = None
+_usernames_lock = threading.Lock()
 
-def create_account(
-    user, password, server_location, shared_secret, admin=False, user_type=None
-):
+# maximum number of usernames whose availability is remembered
+MAX_CACHED_USERNAMES = 10000
+
+
+class HomeserverUnavailable(Exception):
     """
-    creates account
-    https://github.com/matrix-org/synapse/blob/master/synapse/_scripts/register_new_matrix_user.py
+    the homeserver failed repeatedly and is not contacted for a while
+    """
+
+    def __init__(self, server_location, retry_after):
+        super().__init__("%s is unavailable" % server_location)
+        self.server_location = server_location
+        self.retry_after = retry_after
+
+
+class HomeserverBusy(HomeserverUnavailable):
+    """
+    too many registrations are waiting for the homeserver already
+    """
+
+    def __init__(self, server_location, retry_after):
+        super().__init__(server_location, retry_after)
+        self.args = ("%s is busy" % server_location,)
+
+
+class UsernameTaken(Exception):
+    """
+    an account with the requested user id exists already
+    """
+
+    def __init__(self, user_id):
+        super().__init__("%s is already taken" % user_id)
+        self.user_id = user_id
+
+
+class CircuitBreaker:
+    """
+    stops sending requests to a homeserver that keeps failing
+
+    after `threshold` consecutive failures the circuit opens and calls fail
+    immediately for `reset_timeout` seconds. Then it is half open and a
+    single probe is let through, which closes the circuit on success and
+    opens it again on failure.
+    """
+
+    def __init__(self, server_location, threshold, reset_timeout):
+        self.server_location = server_location
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def before_call(self):
+        """
+        raises HomeserverUnavailable if no request should be sent
+
+        Returns
+        -------
+        bool
+            True if the call is the probe, which has to end with success,
+            failure or abandon_probe
+        """
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return False
+            if state == "half-open" and not self.probing:
+                logger.info("probing %s" % self.server_location)
+                self.probing = True
+                return True
+            retry_after = self.reset_timeout
+            if state == "open":
+                retry_after -= time.monotonic() - self.opened_at
+            raise HomeserverUnavailable(self.server_location, max(1, math.ceil(retry_after)))
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("%s is available again" % self.server_location)
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def abandon_probe(self):
+        """
+        lets the next call probe again, for probes that ended without an
+        answer of the homeserver, e.g. because they were cancelled
+        """
+        with self._lock:
+            self.probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                if self.opened_at is None or self.probing:
+                    logger.error(
+                        "%s failed %s times, not contacting it for %s seconds"
+                        % (self.server_location, self.failures, self.reset_timeout)
+                    )
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+
+def get_circuit_breaker(server_location):
+    """
+    returns the circuit breaker guarding a homeserver
+    """
+    server_location = server_location.rstrip("/")
+    with _breakers_lock:
+        breaker = _breakers.get(server_location)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                server_location,
+                config.config.homeserver["failure_threshold"],
+                config.config.homeserver["reset_timeout"],
+            )
+            _breakers[server_location] = breaker
+    return breaker
+
+
+class NoncePool:
+    """
+    keeps nonces for the shared secret registration fetched ahead of time
+
+    a background thread refills the pool whenever a nonce is taken or
+    expires. Synapse only accepts a nonce for a limited time, so nonces
+    older than `ttl` seconds are dropped. If fetching fails the thread
+    stops and is restarted by the next registration.
+    """
+
+    def __init__(self, server_location, size, ttl):
+        self.server_location = server_location
+        self.size = size
+        self.ttl = ttl
+        self.nonces = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.nonces and now - self.nonces[0][0] >= self.ttl:
+            self.nonces.popleft()
+
+    def _refill(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._cond.notify()
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="nonce-pool", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        logger.debug("prefetching nonces from %s" % self.server_location)
+        while True:
+            with self._cond:
+                self._evict()
+                while len(self.nonces) >= self.size:
+                    # wake up when the oldest nonce expires
+                    self._cond.wait(
+                        self.ttl - (time.monotonic() - self.nonces[0][0])
+                    )
+                    self._evict()
+            try:
+                nonce = _get_nonce(self.server_location)
+            except (HomeserverUnavailable, requests.exceptions.RequestException):
+                logger.warning(
+                    "prefetching a nonce from %s failed" % self.server_location,
+                    exc_info=True,
+                )
+                return
+            with self._cond:
+                self.nonces.append((time.monotonic(), nonce))
+
+    def get(self):
+        """
+        returns a fresh nonce or None if the pool is empty
+        """
+        with self._cond:
+            self._evict()
+            nonce = self.nonces.popleft()[1] if self.nonces else None
+            self._refill()
+        return nonce
+
+
+def get_nonce_pool(server_location):
+    """
+    returns the nonce pool of a homeserver
+    """
+    server_location = server_location.rstrip("/")
+    with _nonce_pools_lock:
+        pool = _nonce_pools.get(server_location)
+        if pool is None:
+            pool = NoncePool(
+                server_location,
+                config.config.homeserver["nonce_pool_size"],
+                config.config.homeserver["nonce_ttl"],
+            )
+            _nonce_pools[server_location] = pool
+    return pool
+
+
+class AdmissionControl:
+    """
+    limits the number of concurrent account creations on a homeserver
+
+    at most `limit` registrations are sent to the homeserver at once, up
+    to `queue_size` more wait for `queue_timeout` seconds for a free slot
+    and everything beyond that is rejected right away. A limit of 0
+    admits everything.
+
+    With a `target_latency` the limit adapts to the homeserver: it is
+    lowered by 10% whenever a registration takes longer and slowly raised
+    again up to the configured limit while registrations are fast.
+    """
+
+    def __init__(
+        self, server_location, limit, queue_size, queue_timeout, target_latency=None
+    ):
+        self.server_location = server_location
+        self.max_limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.latency = 1.0
+        self.waiters = collections.deque()
+        self._limit = float(limit)
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def _enter(self, wake):
+        """
+        takes a slot or queues `wake` to be called once one is handed over
+
+        returns if a slot was taken
+        """
+        with self._lock:
+            if not self.max_limit or (
+                self.in_flight < self.limit and not self.waiters
+            ):
+                self.in_flight += 1
+                return True
+            if len(self.waiters) >= self.queue_size:
+                retry_after = self.latency * (len(self.waiters) + 1) / self.limit
+                logger.warning("%s is busy, rejecting registration" % self.server_location)
+                raise HomeserverBusy(self.server_location, max(1, math.ceil(retry_after)))
+            self.waiters.append(wake)
+            return False
+
+    def _leave(self, wake):
+        """
+        takes `wake` out of the queue
+
+        returns False if a slot was handed over already
+        """
+        with self._lock:
+            try:
+                self.waiters.remove(wake)
+            except ValueError:
+                return False
+            return True
+
+    def _abandon(self, wake):
+        """
+        stops waiting, unless a slot was handed over in the meantime
+        """
+        if self._leave(wake):
+            raise HomeserverBusy(self.server_location, max(1, math.ceil(self.latency)))
+
+    def _interrupted(self, wake):
+        """
+        gives up waiting for good, e.g. when the waiting task was cancelled,
+        and frees the slot if one was handed over already
+        """
+        if not self._leave(wake):
+            self.release()
+
+    def release(self, latency=None):
+        """
+        frees a slot and hands it to the longest waiting registration
+
+        Parameters
+        ----------
+        arg1 : float
+            seconds the homeserver took, None if it wasn't contacted
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if latency is not None:
+                self._adapt(latency)
+            while self.waiters and self.in_flight < self.limit:
+                self.in_flight += 1
+                self.waiters.popleft()()
+
+    def _adapt(self, latency):
+        self.latency = 0.8 * self.latency + 0.2 * latency
+        if self.max_limit and self.target_latency:
+            if latency > self.target_latency:
+                self._limit = max(1.0, self._limit * 0.9)
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+    def acquire(self):
+        """
+        waits for a slot
+
+        Raises
+        -------
+        HomeserverBusy:
+            the queue is full or no slot became free in time
+        """
+        event = threading.Event()
+        if self._enter(event.set):
+            return
+        try:
+            handed_over = event.wait(self.queue_timeout)
+        except BaseException:
+            self._interrupted(event.set)
+            raise
+        if not handed_over:
+            self._abandon(event.set)
+
+    async def acquire_async(self):
+        """
+        waits for a slot without blocking the event loop, see acquire
+        """
+        loop = asyncio.get_running_loop()
+        slot = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(slot.set_result, None)
+
+        if self._enter(wake):
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(slot), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(wake)
+        except BaseException:
+            self._interrupted(wake)
+            raise
+
+    @contextlib.contextmanager
+    def admitted(self):
+        self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    @contextlib.asynccontextmanager
+    async def admitted_async(self):
+        await self.acquire_async()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+
+def get_admission_control(server_location):
+    """
+    returns the admission control of a homeserver
+    """
+    locations = _locations(server_location)
+    options = config.config.homeserver
+    with _admission_controls_lock:
+        control = _admission_controls.get(locations)
+        if control is None:
+            control = AdmissionControl(
+                ", ".join(locations),
+                options["max_concurrent"],
+                options["queue_size"],
+                options["queue_timeout"],
+                options["target_latency"],
+            )
+            _admission_controls[locations] = control
+    return control
+
+
+class LoadBalancer:
+    """
+    spreads registrations over the endpoints of a homeserver
+
+    every synapse worker that serves the registration endpoints can be an
+    endpoint. Endpoints whose circuit breaker is open, because they
+    returned 5xx or timed out, are skipped until they are probed again.
+    The strategy "least_outstanding" picks the endpoint with the fewest
+    requests in flight, "round_robin" takes turns.
+    """
+
+    def __init__(self, locations, strategy="least_outstanding"):
+        self.locations = locations
+        self.strategy = strategy
+        self.outstanding = dict.fromkeys(locations, 0)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def choose(self, exclude=()):
+        """
+        returns the endpoint for the next request or None if all are excluded
+
+        Parameters
+        ----------
+        arg1 : list
+            endpoints that failed already
+        """
+        with self._lock:
+            candidates = [l for l in self.locations if l not in exclude]
+            if not candidates:
+                return None
+            healthy = [
+                l for l in candidates if get_circuit_breaker(l).state != "open"
+            ] or candidates
+            # rotate, so ties are broken by taking turns
+            start = self._next % len(healthy)
+            self._next += 1
+            healthy = healthy[start:] + healthy[:start]
+            if self.strategy == "least_outstanding":
+                return min(healthy, key=self.outstanding.__getitem__)
+            return healthy[0]
+
+    def attempts(self):
+        """
+        yields every endpoint once, the best one first
+        """
+        tried = []
+        while True:
+            location = self.choose(tried)
+            if location is None:
+                return
+            tried.append(location)
+            yield location
+
+    @contextlib.contextmanager
+    def track(self, location):
+        with self._lock:
+            self.outstanding[location] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.outstanding[location] -= 1
+
+
+def get_balancer(server_location):
+    """
+    returns the load balancer for the endpoints of a homeserver
+
+    Parameters
+    ----------
+    arg1 : str or list
+        url or urls of the homeserver endpoints
+    """
+    locations = _locations(server_location)
+    with _balancers_lock:
+        balancer = _balancers.get(locations)
+        if balancer is None:
+            balancer = LoadBalancer(locations, config.config.homeserver["balancing"])
+            _balancers[locations] = balancer
+    return balancer
+
+
+def _locations(server_location):
+    """
+    returns the urls of all endpoints of a homeserver
+    """
+    if isinstance(server_location, str):
+        server_location = [server_location]
+    return tuple(location.rstrip("/") for location in server_location)
+
+
+def unhealthy(error):
+    """
+    returns if an error of a homeserver request means that the endpoint
+    should be avoided, rather than that the request was rejected
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response.status_code >= 500
+    return isinstance(
+        error, (HomeserverUnavailable, requests.exceptions.RequestException)
+    )
+
+
+class UsernameCache:
+    """
+    remembers for `ttl` seconds if usernames are taken or free
+
+    None is remembered as well, for homeservers that don't tell.
+    """
+
+    def __init__(self, ttl, max_size=MAX_CACHED_USERNAMES):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        """
+        returns if the user is available or raises KeyError if unknown
+        """
+        with self._lock:
+            checked_at, available = self.entries[user]
+            if time.monotonic() - checked_at >= self.ttl:
+                del self.entries[user]
+                raise KeyError(user)
+            return available
+
+    def set(self, user, available):
+        with self._lock:
+            self.entries.pop(user, None)
+            self.entries[user] = (time.monotonic(), available)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+def get_username_cache():
+    """
+    returns the cache of checked usernames
+    """
+    global _usernames
+    with _usernames_lock:
+        if _usernames is None:
+            _usernames = UsernameCache(config.config.username["availability_ttl"])
+    return _usernames
+
+
+def _availability_request(user, access_token=None):
+    """
+    returns the path and headers to check if a username is available
+
+    the client endpoint is refused by homeservers with disabled
+    registration, the admin endpoint works with an admin access token.
+    """
+    query = urlencode({"username": user})
+    if access_token:
+        path = "/_synapse/admin/v1/username_available?%s" % query
+        return path, {"Authorization": "Bearer %s" % access_token}
+    return "/_matrix/client/v3/register/available?%s" % query, {}
+
+
+def _availability(response):
+    """
+    returns if the response says the username is available, or None
+    """
+    if response.status_code == 200:
+        return bool(response.json().get("available"))
+    try:
+        errcode = response.json().get("errcode")
+    except ValueError:
+        errcode = None
+    if errcode in ("M_USER_IN_USE", "M_EXCLUSIVE"):
+        return False
+    return None
+
+
+def get_session(server_location):
+    """
+    returns the connection pool shared by all requests to a homeserver
+
+    connections are kept alive between registrations, so only the first
+    request has to pay for the tcp and tls handshakes.
 
     Parameters
     ----------
     arg1 : str
-        local part of the new user
-    arg2 : str
-        password
-    arg3 : str
         url to homeserver
-    arg4 : str
-        Registration Shared Secret as set in the homeserver.yaml
-    arg5 : bool
-        register new user as an admin.
-    Raises
-    -------
-    requests.exceptions.ConnectionError:
-        can't connect to homeserver
-    requests.exceptions.HTTPError:
-        something with the communciation to the homeserver failed
     """
-    nonce = _get_nonce(server_location)
+    pool_size = config.config.homeserver["pool_size"]
+    keep_alive = config.config.homeserver["keep_alive"]
+    key = (server_location.rstrip("/"), pool_size, keep_alive)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            logger.debug("opening connection pool to %s" % server_location)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            if not keep_alive:
+                session.headers["Connection"] = "close"
+            _sessions[key] = session
+    return session
 
+
+def _registration_data(nonce, user, password, shared_secret, admin, user_type):
+    """
+    returns the body of a shared secret registration request
+    """
     mac = hmac.new(key=shared_secret.encode("utf8"), digestmod=hashlib.sha1)
 
     mac.update(nonce.encode("utf8"))
@@ -51,7 +653,7 @@ def create_account(
 
     mac = mac.hexdigest()
 
-    data = {
+    return {
         "nonce": nonce,
         "username": user,
         "password": password,
@@ -60,14 +662,236 @@ def create_account(
         "user_type": user_type,
     }
 
+
+Call = collections.namedtuple("Call", "method server_location path kwargs")
+Call.__doc__ = "step of a plan: send a request and send the response back"
+Sleep = collections.namedtuple("Sleep", "seconds")
+Sleep.__doc__ = "step of a plan: wait before going on"
+FetchNonce = collections.namedtuple("FetchNonce", "server_location")
+FetchNonce.__doc__ = "step of a plan: fetch a registration nonce, see nonce_plan"
+
+
+def request_plan(method, server_location, path, retries=0, **kwargs):
+    """
+    plans a request to the homeserver
+
+    connection errors, timeouts and 5xx responses count as failures of the
+    homeserver. They are retried with jittered exponential backoff, which
+    should only be done for idempotent requests.
+
+    This and the other plans don't send anything themselves. They are
+    generators yielding Call, Sleep and FetchNonce steps, a transport
+    carries them out and sends the result back, or throws the error in.
+    Errors have to be raised as the matching requests exceptions. See
+    _run for the one based on requests and asgi._run for the async one.
+
+    Returns
+    -------
+    response with a status code below 400
+
+    Raises
+    -------
+    HomeserverUnavailable:
+        the circuit breaker of the homeserver is open
+    requests.exceptions.RequestException:
+        the request failed
+    """
+    options = config.config.homeserver
     server_location = server_location.rstrip("/")
+    breaker = get_circuit_breaker(server_location)
+    for attempt in range(retries + 1):
+        probe = breaker.before_call()
+        try:
+            r = yield Call(method, server_location, path, kwargs)
+        except requests.exceptions.RequestException as e:
+            breaker.failure()
+            error = e
+        except BaseException:
+            if probe:
+                breaker.abandon_probe()
+            raise
+        else:
+            if r.status_code < 500:
+                breaker.success()
+                if r.status_code >= 400:
+                    raise requests.exceptions.HTTPError(response=r)
+                return r
+            breaker.failure()
+            error = requests.exceptions.HTTPError(response=r)
+        if attempt == retries:
+            raise error
+        delay = options["retry_backoff"] * 2**attempt * random.uniform(0.5, 1.5)
+        logger.warning(
+            "%s %s%s failed, retrying in %.2fs" % (method, server_location, path, delay)
+        )
+        yield Sleep(delay)
 
-    r = requests.post("%s/_synapse/admin/v1/register" % (server_location), json=data)
-    r.raise_for_status()
-    return r.json()
+
+def nonce_plan(server_location):
+    """
+    plans fetching a nonce for the shared secret registration
+    """
+    r = yield from request_plan(
+        "get",
+        server_location,
+        "/_synapse/admin/v1/register",
+        retries=config.config.homeserver["nonce_retries"],
+    )
+    return r.json()["nonce"]
+
+
+def create_account_plan(
+    user, password, server_location, shared_secret, admin=False, user_type=None
+):
+    """
+    plans creating an account, see create_account
+    """
+    balancer = get_balancer(server_location)
+    error = None
+    for location in balancer.attempts():
+        with balancer.track(location):
+            try:
+                nonce = None
+                if config.config.homeserver["nonce_pool_size"]:
+                    nonce = get_nonce_pool(location).get()
+                if nonce is None:
+                    nonce = yield FetchNonce(location)
+            except (HomeserverUnavailable, requests.exceptions.RequestException) as e:
+                if not unhealthy(e):
+                    raise
+                logger.warning("fetching a nonce from %s failed" % location)
+                error = e
+                continue
+
+            # synapse only accepts the nonce on the endpoint that issued it
+            data = _registration_data(
+                nonce, user, password, shared_secret, admin, user_type
+            )
+            r = yield from request_plan(
+                "post", location, "/_synapse/admin/v1/register", json=data
+            )
+            return r.json()
+    raise error
+
+
+def username_available_plan(user, server_location, access_token=None):
+    """
+    plans checking if a username is available, see username_available
+    """
+    cache = get_username_cache()
+    try:
+        return cache.get(user)
+    except KeyError:
+        pass
+    path, headers = _availability_request(user, access_token)
+    location = get_balancer(server_location).choose()
+    try:
+        response = yield from request_plan("get", location, path, headers=headers)
+    except (HomeserverUnavailable, requests.exceptions.RequestException) as e:
+        if unhealthy(e):
+            logger.warning("checking if %s is available failed" % user, exc_info=True)
+            return None
+        response = e.response
+    available = _availability(response)
+    cache.set(user, available)
+    return available
+
+
+def _run(plan):
+    """
+    carries out a plan with the connection pools of requests
+
+    Returns
+    -------
+    the result of the plan
+    """
+    value = error = None
+    while True:
+        try:
+            step = plan.send(value) if error is None else plan.throw(error)
+        except StopIteration as e:
+            return e.value
+        value = error = None
+        try:
+            if isinstance(step, Sleep):
+                time.sleep(step.seconds)
+            elif isinstance(step, FetchNonce):
+                value = _get_nonce(step.server_location)
+            else:
+                value = _send(step)
+        except BaseException as e:
+            # the plan cleans up, e.g. abandons a probe, and raises it again
+            error = e
+
+
+def _send(call):
+    options = config.config.homeserver
+    send = getattr(get_session(call.server_location), call.method)
+    return send(
+        "%s%s" % (call.server_location, call.path),
+        timeout=(options["connect_timeout"], options["read_timeout"]),
+        **call.kwargs,
+    )
+
+
+def username_available(user, server_location, access_token=None):
+    """
+    checks with the homeserver if a username is available
+
+    answers are cached, failed checks are not.
+
+    Parameters
+    ----------
+    arg1 : str
+        local part of the user
+    arg2 : str or list
+        url to homeserver, or the urls of its endpoints
+    arg3 : str
+        optional access token of a homeserver admin
+    Returns
+    -------
+    bool or None
+        None if the homeserver didn't tell
+    """
+    return _run(username_available_plan(user, server_location, access_token))
+
+
+def create_account(
+    user, password, server_location, shared_secret, admin=False, user_type=None
+):
+    """
+    creates account
+    https://github.com/matrix-org/synapse/blob/master/synapse/_scripts/register_new_matrix_user.py
+
+    Parameters
+    ----------
+    arg1 : str
+        local part of the new user
+    arg2 : str
+        password
+    arg3 : str or list
+        url to homeserver, or the urls of its endpoints
+    arg4 : str
+        Registration Shared Secret as set in the homeserver.yaml
+    arg5 : bool
+        register new user as an admin.
+    Raises
+    -------
+    HomeserverUnavailable:
+        the homeserver failed too often recently
+    requests.exceptions.ConnectionError:
+        can't connect to homeserver
+    requests.exceptions.Timeout:
+        the homeserver didn't answer in time
+    requests.exceptions.HTTPError:
+        something with the communciation to the homeserver failed
+    """
+    return _run(
+        create_account_plan(
+            user, password, server_location, shared_secret, admin, user_type
+        )
+    )
 
 
 def _get_nonce(server_location):
-    r = requests.get("%s/_synapse/admin/v1/register" % (server_location))
-    r.raise_for_status()
-    return r.json()["nonce"]
+    return _run(nonce_plan(server_location))
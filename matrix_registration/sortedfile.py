@@ -0,0 +1,155 @@
+# Standard library imports...
+import logging
+import mmap
+
+logger = logging.getLogger(__name__)
+
+HASH_FILE_MAGIC = b"MRHASH1"
+# magic and one byte with the length of the records
+HASH_FILE_HEADER = len(HASH_FILE_MAGIC) + 1
+
+
+class SortedFile:
+    """
+    looks up lines in a large sorted file without reading it
+
+    the file is memory-mapped, so it isn't parsed on startup and all
+    processes share the pages cached by the os. Lines are searched by
+    binary search and must be sorted bytewise, e.g. with `LC_ALL=C sort`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files can't be mapped
+                self.data = b""
+        logger.debug("mapped %s (%s bytes)" % (path, len(self.data)))
+
+    def __contains__(self, key):
+        """
+        returns if a line equals the key
+
+        Parameters
+        ----------
+        arg1 : bytes
+            line without the newline
+        """
+        data = self.data
+        lo, hi = 0, len(data)
+        # lo is always at the start of a line, hi right after a newline
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind(b"\n", lo, mid) + 1 or lo
+            end = data.find(b"\n", start, hi)
+            if end == -1:
+                end = hi
+            line = data[start:end].rstrip(b"\r")
+            if line == key:
+                return True
+            if line < key:
+                lo = end + 1
+            else:
+                hi = start
+        return False
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+class HashFile:
+    """
+    looks up hashes in a large sorted binary file without reading it
+
+    the file starts with HASH_FILE_MAGIC and the length of its records,
+    followed by the sorted hashes, or prefixes of them, as fixed size
+    records. A lookup is a binary search over the memory-mapped records,
+    so it only touches a few pages even for a multi-gigabyte file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(HASH_FILE_HEADER)
+            if header[:-1] != HASH_FILE_MAGIC or not header[-1:].strip(b"\0"):
+                raise ValueError("%s is not a hash file" % path)
+            self.record_length = header[-1]
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = (len(self.data) - HASH_FILE_HEADER) // self.record_length
+        logger.debug("mapped %s (%s hashes)" % (path, self.count))
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, digest):
+        """
+        returns if the file contains the digest, or its prefix
+
+        Parameters
+        ----------
+        arg1 : bytes
+            digest at least as long as the records
+        """
+        key = digest[: self.record_length]
+        length = self.record_length
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = HASH_FILE_HEADER + mid * length
+            record = self.data[start : start + length]
+            if record == key:
+                return True
+            if record < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return False
+
+    def close(self):
+        self.data.close()
+
+
+def write_hash_file(hashes, target, record_length=20):
+    """
+    writes hex encoded hashes into a hash file
+
+    the hashes have to be sorted, like the "ordered by hash" downloads of
+    Have I Been Pwned. Lines may end with ':count'.
+
+    Parameters
+    ----------
+    arg1 : iterable
+        lines with a hex encoded hash each
+    arg2 : str
+        path of the hash file
+    arg3 : int
+        bytes kept of every hash, shorter prefixes save space but reject
+        more passwords by chance
+
+    Returns
+    -------
+    int
+        number of records written
+    """
+    count = 0
+    previous = b""
+    with open(target, "wb") as f:
+        f.write(HASH_FILE_MAGIC + bytes([record_length]))
+        for line in hashes:
+            line = line.strip()
+            if not line:
+                continue
+            record = bytes.fromhex(line.split(":", 1)[0])[:record_length]
+            if len(record) != record_length:
+                raise ValueError("%s is shorter than %s bytes" % (line, record_length))
+            if record <= previous:
+                if record == previous:
+                    continue
+                raise ValueError("hashes are not sorted at %s" % line)
+            f.write(record)
+            previous = record
+            count += 1
+    return count
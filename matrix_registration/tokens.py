@@ -1,69 +1,319 @@
 # Standard library imports...
-from datetime import datetime
+from datetime import datetime, timedelta
+import collections
+import csv
+import functools
+import io
+import ipaddress
+import json
 import logging
-import random
+import secrets
+import threading
+import time
 
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import (
+    and_,
+    delete,
     exc,
-    Table,
+    false,
+    insert,
+    not_,
+    or_,
+    select,
+    true,
+    update,
     Column,
     Integer,
     String,
     Boolean,
     DateTime,
     ForeignKey,
+    Index,
+    LargeBinary,
+    func,
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import relationship, selectinload
 
 # Local imports...
+from . import config
 from .constants import WORD_LIST_PATH
 
 
 logger = logging.getLogger(__name__)
 
+# number of clients whose unknown token lookups are counted
+MAX_TRACKED_CLIENTS = 10000
+# maximum number of tokens that can be created at once
+MAX_TOKEN_BATCH = 100000
+
 db = SQLAlchemy()
 session = db.session
 
 
+@functools.lru_cache(maxsize=None)
+def load_wordlist(path=WORD_LIST_PATH):
+    """
+    reads a wordlist once and returns its words title cased
+
+    words that would not match the token pattern `^([A-Z][a-z]+)+$` are
+    skipped.
+    """
+    with open(path) as f:
+        words = {line.strip().lower() for line in f}
+    return tuple(
+        sorted(word.title() for word in words if word.isascii() and word.isalpha())
+    )
+
+
+class NameGenerator:
+    """
+    generates readable token names, e.g. 'DoubleWizardSki'
+
+    the wordlist is only read once per path and words are drawn with
+    `secrets`, so names can't be predicted from earlier ones.
+    """
+
+    def __init__(self, length=3, wordlist=None):
+        self.length = length
+        self.words = load_wordlist(wordlist or WORD_LIST_PATH)
+        if not self.words:
+            raise ValueError("wordlist %s contains no usable words" % wordlist)
+
+    def __call__(self, exists=None, attempts=10):
+        """
+        returns a new name
+
+        Parameters
+        ----------
+        arg1 : callable
+            returns True if a name is already taken
+        arg2 : int
+            number of names to try before giving up
+        """
+        for _ in range(attempts):
+            name = "".join(secrets.choice(self.words) for _ in range(self.length))
+            if exists is None or not exists(name):
+                return name
+        raise RuntimeError("could not generate an unused token name")
+
+
 def random_readable_string(length=3, wordlist=WORD_LIST_PATH):
-    with open(wordlist) as f:
-        lines = f.read().splitlines()
-        string = ""
-        for _ in range(length):
-            string += random.choice(lines).title()
-    return string
-
-
-association_table = Table(
-    "association",
-    db.Model.metadata,
-    Column("ips", Integer, ForeignKey("ips.id"), primary_key=True),
-    Column("tokens", String(255), ForeignKey("tokens.name"), primary_key=True),
-)
+    return NameGenerator(length, wordlist)()
+
+
+def serialize_tokens(tokens, fmt="ndjson"):
+    """
+    yields tokens line by line, so large batches can be streamed
+
+    Parameters
+    ----------
+    arg1 : iterable
+        Token or CachedToken objects
+    arg2 : str
+        'ndjson', 'csv' or 'plain' for just the names
+    """
+    if fmt == "plain":
+        for token in tokens:
+            yield "%s\n" % token.name
+    elif fmt == "csv":
+        buffer = io.StringIO()
+        writer = None
+        for token in tokens:
+            row = token.toDict()
+            row.pop("ips", None)
+            if writer is None:
+                writer = csv.DictWriter(buffer, fieldnames=list(row), lineterminator="\n")
+                writer.writeheader()
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    else:
+        for token in tokens:
+            yield json.dumps(token.toDict()) + "\n"
+
+
+def pack_addresses(ip_addresses):
+    """
+    converts ip addresses to their packed binary form
+
+    Parameters
+    ----------
+    arg1 : str or list
+        addresses, entries may contain several comma separated addresses
+        as found in the X-Forwarded-For header
+
+    Returns
+    -------
+    list
+        packed addresses in order, without duplicates and invalid entries
+    """
+    if isinstance(ip_addresses, str):
+        ip_addresses = [ip_addresses]
+    packed = []
+    for entry in filter(None, ip_addresses):
+        for address in entry.split(","):
+            try:
+                ip = ipaddress.ip_address(address.strip())
+            except ValueError:
+                logger.warning("not logging invalid ip address: %s" % address)
+                continue
+            if ip.version == 6 and ip.ipv4_mapped:
+                ip = ip.ipv4_mapped
+            if ip.packed not in packed:
+                packed.append(ip.packed)
+    return packed
+
+
+def address_ids(packed):
+    """
+    returns the ids of packed addresses, adding the missing ones
+    """
+    if not packed:
+        return {}
+    statement = select(Address.packed, Address.id).where(Address.packed.in_(packed))
+    ids = dict(session.execute(statement).all())
+    missing = [address for address in packed if address not in ids]
+    if missing:
+        try:
+            with session.begin_nested():
+                session.execute(insert(Address), [{"packed": a} for a in missing])
+        except exc.IntegrityError:
+            # inserted concurrently by another registration
+            pass
+        ids = dict(session.execute(statement).all())
+    return ids
+
+
+def usage_address_rows(usage_id, ip_address=False):
+    """
+    returns the logged addresses of one token usage with their position in
+    the forwarded chain, empty if ip logging is disabled
+    """
+    packed = pack_addresses(ip_address) if ip_address else []
+    ids = address_ids(packed)
+    return [
+        {"usage_id": usage_id, "position": position, "address_id": ids[address]}
+        for position, address in enumerate(packed)
+    ]
+
+
+def next_generation(purge=False):
+    """
+    bumps the generation counter of the token table
+
+    the returned value has to be written to every token row changed in the
+    same transaction, so that caches can fetch just the rows newer than the
+    generation they last saw.
+
+    Parameters
+    ----------
+    arg1 : bool
+        rows were deleted, caches can not be updated incrementally
+
+    Returns
+    -------
+    int
+        the new generation
+    """
+    values = {"generation": TokenState.generation + 1}
+    if purge:
+        values["purge_generation"] = TokenState.generation + 1
+    result = session.execute(
+        update(TokenState).where(TokenState.id == 1).values(**values)
+    )
+    if not result.rowcount:
+        session.add(TokenState(id=1, generation=1, purge_generation=int(purge)))
+        session.flush()
+    return session.execute(
+        select(TokenState.generation).where(TokenState.id == 1)
+    ).scalar_one()
+
 
+def token_active(expiration_date, max_usage, used, disabled):
+    expired = False
+    if expiration_date:
+        expired = expiration_date < datetime.now()
+    used = max_usage != 0 and max_usage <= used
 
-class IP(db.Model):
-    __tablename__ = "ips"
+    return (not expired) and (not used) and (not disabled)
+
+
+class TokenState(db.Model):
+    """
+    single row table holding the generation of the token table
+
+    every change to the tokens increments `generation`, deletions also set
+    `purge_generation`, so instances only have to compare two integers to
+    know whether their cache is stale.
+    """
+
+    __tablename__ = "token_state"
+    id = Column(Integer, primary_key=True)
+    generation = Column(Integer, default=0, nullable=False)
+    purge_generation = Column(Integer, default=0, nullable=False)
+
+
+class Address(db.Model):
+    """
+    ip address of a client, stored once in packed form (4 or 16 bytes)
+    """
+
+    __tablename__ = "addresses"
     id = Column(Integer, primary_key=True)
-    address = Column(String(255))
+    packed = Column(LargeBinary(16), nullable=False, unique=True)
 
     def __repr__(self):
-        return self.address
+        return str(ipaddress.ip_address(self.packed))
+
+
+class UsageAddress(db.Model):
+    """
+    address of a token usage, `position` is its place in the forwarded chain
+    """
+
+    __tablename__ = "token_usage_addresses"
+    usage_id = Column(Integer, ForeignKey("token_usages.id"), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    address_id = Column(Integer, ForeignKey("addresses.id"), nullable=False)
+    address = relationship("Address", lazy="joined")
+
+
+class TokenUsage(db.Model):
+    """
+    a single use of a token
+
+    the addresses of the forwarded chain are kept in `token_usage_addresses`,
+    there are none if ip logging is disabled.
+    """
+
+    __tablename__ = "token_usages"
+    id = Column(Integer, primary_key=True)
+    token = Column(String(255), ForeignKey("tokens.name"), nullable=False, index=True)
+    used_at = Column(DateTime, nullable=True)
+    addresses = relationship(
+        "UsageAddress",
+        lazy="selectin",
+        order_by="UsageAddress.position",
+        cascade="all",
+    )
 
 
 class Token(db.Model):
     __tablename__ = "tokens"
+    __table_args__ = (
+        Index("ix_tokens_disabled_expiration_date", "disabled", "expiration_date"),
+    )
     name = Column(String(255), primary_key=True)
     expiration_date = Column(DateTime, nullable=True)
     max_usage = Column(Integer, default=1)
     used = Column(Integer, default=0)
     disabled = Column(Boolean, default=False)
-    ips = relationship(
-        "IP",
-        secondary=association_table,
-        lazy="subquery",
-        backref=db.backref("pages", lazy=True),
+    generation = Column(Integer, default=0, index=True)
+    usages = relationship(
+        "TokenUsage", lazy="select", order_by="TokenUsage.id", cascade="all"
     )
 
     def __init__(self, **kwargs):
@@ -78,6 +328,12 @@ class Token(db.Model):
     def __repr__(self):
         return self.name
 
+    @property
+    def ips(self):
+        return [
+            str(entry.address) for usage in self.usages for entry in usage.addresses
+        ]
+
     def toDict(self):
         _token = {
             "name": self.name,
@@ -86,38 +342,139 @@ class Token(db.Model):
             if self.expiration_date
             else None,
             "max_usage": self.max_usage,
-            "ips": list(map(lambda x: x.address, self.ips)),
+            "ips": self.ips,
             "disabled": bool(self.disabled),
             "active": self.active(),
         }
         return _token
 
+    @hybrid_property
+    def is_active(self):
+        return token_active(
+            self.expiration_date, self.max_usage, self.used, self.disabled
+        )
+
+    @is_active.expression
+    def is_active(cls):
+        return and_(
+            # a plain comparison, so ix_tokens_disabled_expiration_date is used
+            cls.disabled == false(),
+            or_(cls.max_usage == 0, cls.used < cls.max_usage),
+            not_(cls.is_expired),
+        )
+
+    @hybrid_property
+    def is_expired(self):
+        return bool(self.expiration_date) and self.expiration_date < datetime.now()
+
+    @is_expired.expression
+    def is_expired(cls):
+        return and_(
+            cls.expiration_date.isnot(None), cls.expiration_date < datetime.now()
+        )
+
+    @hybrid_property
+    def is_disabled(self):
+        return bool(self.disabled)
+
+    @is_disabled.expression
+    def is_disabled(cls):
+        return cls.disabled == true()
+
     def active(self):
-        expired = False
-        if self.expiration_date:
-            expired = self.expiration_date < datetime.now()
-        used = self.max_usage != 0 and self.max_usage <= self.used
-
-        return (not expired) and (not used) and (not self.disabled)
-
-    def use(self, ip_address=False):
-        if self.active():
-            self.used += 1
-            if ip_address:
-                self.ips.append(IP(address=ip_address))
-            return True
-        return False
+        return self.is_active
 
     def disable(self):
         if not self.disabled:
             self.disabled = True
+            self.generation = next_generation()
             return True
         return False
 
 
+class TokenLease(db.Model):
+    """
+    usage of a token that is held while an account is being created
+    """
+
+    __tablename__ = "token_leases"
+    # random, so an id can never refer to a newer lease after a reclaim
+    id = Column(String(32), primary_key=True)
+    token = Column(String(255), ForeignKey("tokens.name"), nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class CachedToken:
+    """
+    read-only snapshot of a token row
+
+    unlike `Token` it is not bound to a session and can be shared between
+    requests and threads.
+    """
+
+    __slots__ = ("name", "expiration_date", "max_usage", "used", "disabled")
+    columns = (
+        Token.name,
+        Token.expiration_date,
+        Token.max_usage,
+        Token.used,
+        Token.disabled,
+    )
+
+    def __init__(self, name, expiration_date, max_usage, used, disabled):
+        self.name = name
+        self.expiration_date = expiration_date
+        self.max_usage = max_usage
+        self.used = used
+        self.disabled = disabled
+
+    @classmethod
+    def from_token(cls, token):
+        return cls(*(getattr(token, column.key) for column in cls.columns))
+
+    def __repr__(self):
+        return self.name
+
+    def active(self):
+        return token_active(
+            self.expiration_date, self.max_usage, self.used, self.disabled
+        )
+
+    def toDict(self):
+        return {
+            "name": self.name,
+            "used": self.used,
+            "expiration_date": str(self.expiration_date)
+            if self.expiration_date
+            else None,
+            "max_usage": self.max_usage,
+            "disabled": bool(self.disabled),
+            "active": self.active(),
+        }
+
+
 class Tokens:
+    """
+    token store
+
+    keeps a snapshot of all tokens in memory, which is brought up to date
+    by comparing its generation with the one stored in the database. Only
+    rows changed since then are fetched, so checking a token name usually
+    costs a single primary key lookup on `token_state`, even with several
+    instances sharing the database.
+
+    Using a token doesn't change the generation, so registrations never
+    write to the shared `token_state` row. The usage counts in the cache
+    can be outdated, `active` reads the row of the token instead.
+    """
+
     def __init__(self):
         self.tokens = {}
+        self.generation = None
+        self.refreshed_at = 0
+        self.misses = collections.Counter()
+        self._lock = threading.Lock()
+        self.generate_name = NameGenerator(**config.config.token_name)
 
         self.load()
 
@@ -128,20 +485,167 @@ class Tokens:
         return result[:-2]
 
     def toList(self):
-        _tokens = []
-        for tokens_key in self.tokens:
-            _tokens.append(self.tokens[tokens_key].toDict())
-        return _tokens
+        return [
+            token.toDict()
+            for token in Token.query.options(selectinload(Token.usages)).all()
+        ]
+
+    def _filter(
+        self,
+        statement,
+        active=None,
+        expired=None,
+        disabled=None,
+        used_gt=None,
+        prefix=None,
+    ):
+        for flag, clause, negated in (
+            (active, Token.is_active, not_(Token.is_active)),
+            (expired, Token.is_expired, not_(Token.is_expired)),
+            (disabled, Token.is_disabled, Token.disabled == false()),
+        ):
+            if flag is not None:
+                statement = statement.where(clause if flag else negated)
+        if used_gt is not None:
+            statement = statement.where(Token.used > used_gt)
+        if prefix:
+            statement = statement.where(Token.name.startswith(prefix, autoescape=True))
+        return statement
+
+    def query(self, after=None, limit=None, **filters):
+        """
+        returns tokens ordered by name, filtered by the database
+
+        Parameters
+        ----------
+        after : str
+            only return tokens with a name after this one (keyset pagination)
+        limit : int
+            maximum number of tokens to return
+        active, expired, disabled : bool
+            only return tokens in or not in this state
+        used_gt : int
+            only return tokens used more often than this
+        prefix : str
+            only return tokens whose name starts with this
+        """
+        statement = self._filter(
+            select(Token)
+            .options(selectinload(Token.usages))
+            .order_by(Token.name),
+            **filters,
+        )
+        if after:
+            statement = statement.where(Token.name > after)
+        if limit:
+            statement = statement.limit(limit)
+        return session.execute(statement).scalars().all()
+
+    def names(self, **filters):
+        """
+        returns the names of all tokens matching the filters of `query`
+        """
+        statement = self._filter(select(Token.name).order_by(Token.name), **filters)
+        return session.execute(statement).scalars().all()
+
+    def count(self, **filters):
+        """
+        counts the tokens matching the filters of `query`
+        """
+        statement = self._filter(select(func.count()).select_from(Token), **filters)
+        return session.execute(statement).scalar_one()
+
+    def _state(self):
+        state = session.execute(
+            select(TokenState.generation, TokenState.purge_generation).where(
+                TokenState.id == 1
+            )
+        ).first()
+        if state is None:
+            try:
+                session.add(TokenState(id=1, generation=0, purge_generation=0))
+                session.commit()
+            except exc.IntegrityError:
+                # another instance created the row in the meantime
+                session.rollback()
+            return self._state()
+        return state
+
+    def _cache(self, token):
+        with self._lock:
+            self.tokens[token.name] = CachedToken.from_token(token)
+            # skip the refetch of our own change if nobody else wrote since
+            if self.generation is not None and token.generation == self.generation + 1:
+                self.generation = token.generation
 
     def load(self):
         logger.debug("loading tokens from ..")
-        self.tokens = {}
-        for token in Token.query.all():
-            logger.debug(token)
-            self.tokens[token.name] = token
+        state = self._state()
+        rows = session.execute(select(*CachedToken.columns)).all()
+        with self._lock:
+            self.tokens = {row.name: CachedToken(*row) for row in rows}
+            self.generation = state.generation
 
         logger.debug("token loaded!")
 
+    def refresh(self):
+        """
+        brings the cache up to date with the database
+        """
+        state = self._state()
+        self.refreshed_at = time.monotonic()
+        if state.generation == self.generation:
+            return
+        if self.generation is None or state.purge_generation > self.generation:
+            self.load()
+            return
+
+        logger.debug(
+            "refreshing tokens from generation %s to %s"
+            % (self.generation, state.generation)
+        )
+        rows = session.execute(
+            select(*CachedToken.columns).where(Token.generation > self.generation)
+        ).all()
+        with self._lock:
+            for row in rows:
+                self.tokens[row.name] = CachedToken(*row)
+            self.generation = state.generation
+
+    def known(self, token_name, client=None):
+        """
+        checks whether a token exists without asking the database
+
+        the cache holds the names of all tokens, so unknown names, e.g. from
+        someone guessing tokens, can be rejected right away. The database is
+        only consulted if the cache wasn't refreshed for `token_cache_ttl`
+        seconds, in case another instance created the token.
+
+        Parameters
+        ----------
+        arg1 : str
+            token name
+        arg2 : str
+            client the name came from, counted in `misses` if it's unknown
+        """
+        if token_name in self.tokens:
+            return True
+        if time.monotonic() - self.refreshed_at > config.config.token_cache_ttl:
+            self.refresh()
+            if token_name in self.tokens:
+                return True
+
+        with self._lock:
+            self.misses[client] += 1
+            misses = self.misses[client]
+            if len(self.misses) > MAX_TRACKED_CLIENTS:
+                self.misses = collections.Counter(
+                    dict(self.misses.most_common(MAX_TRACKED_CLIENTS // 2))
+                )
+        if misses % 100 == 0:
+            logger.warning("%s tried %s unknown tokens" % (client, misses))
+        return False
+
     def get_token(self, token_name):
         logger.debug("getting token by name: %s" % token_name)
         try:
@@ -152,19 +656,196 @@ class Tokens:
 
     def active(self, token_name):
         logger.debug('checking if "%s" is active' % token_name)
-        token = self.get_token(token_name)
-        if token:
-            return token.active()
-        return False
+        token = self._read(token_name)
+        if token is None or token.active():
+            return token is not None
+        # usages held by leases that were never confirmed or released
+        if self.reclaim(token_name):
+            token = self._read(token_name)
+        return token is not None and token.active()
+
+    def _read(self, token_name):
+        """
+        reads a token from the database into the cache
+
+        usage counts don't get a new generation, so only the row itself has
+        the current one.
+        """
+        row = session.execute(
+            select(*CachedToken.columns).where(Token.name == token_name)
+        ).first()
+        with self._lock:
+            if row is None:
+                self.tokens.pop(token_name, None)
+                return None
+            token = self.tokens[token_name] = CachedToken(*row)
+        return token
+
+    def _add_usage(self, token_name, amount):
+        """
+        changes the usage count of a token
+
+        increments are conditional on the token being active, so the row
+        count tells whether a usage could be taken. The generation is left
+        alone, otherwise every registration would have to lock the single
+        `token_state` row until it commits.
+        """
+        statement = update(Token).where(Token.name == token_name)
+        if amount > 0:
+            statement = statement.where(Token.is_active)
+        result = session.execute(
+            statement.values(used=Token.used + amount).execution_options(
+                synchronize_session=False
+            )
+        )
+        return result.rowcount == 1
+
+    def _record_usage(self, token_name, ip_address):
+        result = session.execute(
+            insert(TokenUsage).values(token=token_name, used_at=datetime.now())
+        )
+        rows = usage_address_rows(result.inserted_primary_key[0], ip_address)
+        if rows:
+            session.execute(insert(UsageAddress), rows)
+
+    def _cache_name(self, token_name):
+        self._cache(
+            session.execute(
+                select(*CachedToken.columns, Token.generation).where(
+                    Token.name == token_name
+                )
+            ).one()
+        )
 
     def use(self, token_name, ip_address=False):
+        """
+        consumes one usage of a token
+
+        the activity check and the increment happen in a single conditional
+        UPDATE, so concurrent registrations can never push a token past its
+        `max_usage`, no matter how many threads or processes race for it.
+
+        Parameters
+        ----------
+        arg1 : str
+            token name
+        arg2 : str
+            ip address(es) of the client, if they should be logged
+
+        Returns
+        -------
+        bool
+            whether the token could be used
+        """
         logger.debug("using token: %s" % token_name)
-        token = self.get_token(token_name)
-        if token:
-            if token.use(ip_address):
-                session.commit()
-                return True
-        return False
+        if not self._add_usage(token_name, 1):
+            return False
+        self._record_usage(token_name, ip_address)
+        session.commit()
+        self._cache_name(token_name)
+        return True
+
+    def reserve(self, token_name, ttl=None):
+        """
+        reserves one usage of a token for a limited time
+
+        the usage is taken immediately, so other registrations can not claim
+        it while the account is being created. It has to be either confirmed
+        or released afterwards, otherwise it is given back to the token once
+        the lease expired.
+
+        Parameters
+        ----------
+        arg1 : str
+            token name
+        arg2 : int
+            lifetime of the lease in seconds, defaults to `token_lease_ttl`
+
+        Returns
+        -------
+        str
+            id of the lease or None if the token can not be used
+        """
+        logger.debug("reserving token: %s" % token_name)
+        if ttl is None:
+            ttl = config.config.token_lease_ttl
+        self.reclaim()
+        if not self._add_usage(token_name, 1):
+            return None
+        lease_id = secrets.token_hex(16)
+        session.add(
+            TokenLease(
+                id=lease_id,
+                token=token_name,
+                expires_at=datetime.now() + timedelta(seconds=ttl),
+            )
+        )
+        session.commit()
+        self._cache_name(token_name)
+        return lease_id
+
+    def confirm(self, lease_id, token_name, ip_address=False):
+        """
+        turns a lease into a regular usage of the token
+
+        if the lease expired and was reclaimed in the meantime, the token is
+        used again instead.
+
+        Returns
+        -------
+        bool
+            whether the usage could be kept
+        """
+        logger.debug("confirming lease %s of token: %s" % (lease_id, token_name))
+        result = session.execute(delete(TokenLease).where(TokenLease.id == lease_id))
+        if result.rowcount != 1:
+            logger.warning(
+                "lease %s of %s expired before confirmation" % (lease_id, token_name)
+            )
+            session.rollback()
+            return self.use(token_name, ip_address)
+        self._record_usage(token_name, ip_address)
+        session.commit()
+        return True
+
+    def release(self, lease_id, token_name):
+        """
+        gives the usage held by a lease back to the token
+        """
+        logger.debug("releasing lease %s of token: %s" % (lease_id, token_name))
+        result = session.execute(delete(TokenLease).where(TokenLease.id == lease_id))
+        if result.rowcount != 1:
+            session.rollback()
+            return False
+        self._add_usage(token_name, -1)
+        session.commit()
+        self._cache_name(token_name)
+        return True
+
+    def reclaim(self, token_name=None):
+        """
+        releases all expired leases
+
+        Parameters
+        ----------
+        arg1 : str
+            only release the leases of this token
+
+        Returns
+        -------
+        int
+            number of released leases
+        """
+        statement = select(TokenLease.id, TokenLease.token).where(
+            TokenLease.expires_at < datetime.now()
+        )
+        if token_name is not None:
+            statement = statement.where(TokenLease.token == token_name)
+        released = 0
+        for lease_id, name in session.execute(statement).all():
+            logger.info("reclaiming expired lease %s of %s" % (lease_id, name))
+            released += self.release(lease_id, name)
+        return released
 
     def update(self, token_name, data):
         logger.debug("updating token: %s" % token_name)
@@ -179,7 +860,9 @@ class Tokens:
             token.used = data["used"]
         if "disabled" in data:
             token.disabled = data["disabled"]
+        token.generation = next_generation()
         session.commit()
+        self._cache(token)
         return True
 
     def disable(self, token_name):
@@ -188,17 +871,27 @@ class Tokens:
         if token:
             if token.disable():
                 session.commit()
+                self._cache(token)
                 return True
         return False
 
     def delete(self, token_name):
         logger.debug("disabling token: %s" % token_name)
         try:
+            session.execute(delete(TokenLease).where(TokenLease.token == token_name))
+            usages = select(TokenUsage.id).where(TokenUsage.token == token_name)
+            session.execute(
+                delete(UsageAddress).where(UsageAddress.usage_id.in_(usages))
+            )
+            session.execute(delete(TokenUsage).where(TokenUsage.token == token_name))
             Token.query.filter_by(name=token_name).delete()
+            next_generation(purge=True)
             session.commit()
         except exc.SQLAlchemyError as e:
             logger.exception(e)
             return False
+        with self._lock:
+            self.tokens.pop(token_name, None)
         return True
 
     def new(self, expiration_date=None, max_usage=False):
@@ -208,12 +901,96 @@ class Tokens:
                 + "expiration_dates: {}"
             ).format(max_usage, expiration_date)
         )
-        token = Token(expiration_date=expiration_date, max_usage=max_usage)
-        self.tokens[token.name] = token
+        self.refresh()
+        token = Token(
+            name=self.generate_name(exists=self.tokens.__contains__),
+            expiration_date=expiration_date,
+            max_usage=max_usage,
+        )
+        token.generation = next_generation()
         session.add(token)
         session.commit()
+        self._cache(token)
 
         return token
 
+    def new_batch(self, count, expiration_date=None, max_usage=False, retries=3):
+        """
+        creates many tokens in a single transaction
+
+        names are generated in memory and checked against the freshly
+        refreshed cache, then all rows are inserted at once. If another
+        instance created one of the names in the meantime the whole batch
+        is generated again.
+
+        Parameters
+        ----------
+        arg1 : int
+            number of tokens to create
+        arg2 : datetime
+            expiration date of all tokens
+        arg3 : int
+            times each token can be used
+
+        Returns
+        -------
+        list
+            CachedToken of every created token
+
+        Raises
+        -------
+        ValueError
+            count is less than 1
+        """
+        if count < 1:
+            raise ValueError("count has to be at least 1, not %s" % count)
+        logger.debug(
+            "creating %s new tokens, with options: max_usage: %s, expiration_date: %s"
+            % (count, max_usage, expiration_date)
+        )
+        for attempt in range(retries):
+            self.refresh()
+            names = set()
+            while len(names) < count:
+                names.add(
+                    self.generate_name(
+                        exists=lambda name: name in self.tokens or name in names
+                    )
+                )
+
+            created = [
+                CachedToken(name, expiration_date, int(max_usage or 0), 0, False)
+                for name in names
+            ]
+            try:
+                generation = next_generation()
+                session.execute(
+                    insert(Token),
+                    [
+                        {
+                            "name": token.name,
+                            "expiration_date": token.expiration_date,
+                            "max_usage": token.max_usage,
+                            "used": token.used,
+                            "disabled": token.disabled,
+                            "generation": generation,
+                        }
+                        for token in created
+                    ],
+                )
+                session.commit()
+            except exc.IntegrityError:
+                logger.warning("token name collision, generating batch again")
+                session.rollback()
+                continue
+
+            with self._lock:
+                for token in created:
+                    self.tokens[token.name] = token
+                if self.generation is not None and generation == self.generation + 1:
+                    self.generation = generation
+            return created
+        raise RuntimeError("could not generate %s unique token names" % count)
+
 
 tokens = None
@@ -1,3 +1,4 @@
+import functools
 import os
 import re
 
@@ -7,32 +8,103 @@ from .constants import __location__
 
 
 replace_pattern = re.compile(r"{{\s*(?P<name>.[a-zA-Z_\-]+)\s*}}")
+catalog_pattern = re.compile(r"^messages\.(?P<lang>.+)\.yaml$")
+DEFAULT_LANGUAGE = "en"
 
 
 def get_translations(lang="en", replacements={}):
-    default = _get_translations(replacements=replacements)
-    try:
-        selected = _get_translations(lang=lang, replacements=replacements)
-        return {**default, **selected}
-    except IOError:
-        return default
+    """
+    returns the strings of a language, english ones fill the gaps
 
+    Parameters
+    ----------
+    arg1 : str
+        language tag, e.g. 'pt-BR', unsupported ones fall back to english
+    arg2 : dict
+        values for the placeholders, e.g. {'server_name': 'matrix.org'}
+    """
+    return _interpolate(negotiate(lang), tuple(sorted(replacements.items())))
 
-def _get_translations(lang="en", replacements={}):
-    path = os.path.join(__location__, f"translations/messages.{lang}.yaml")
 
-    with open(path, "r") as stream:
-        translations = yaml.load(stream, Loader=yaml.SafeLoader)
+@functools.lru_cache(maxsize=64)
+def _interpolate(lang, replacements):
+    replacements = dict(replacements)
+    return {
+        key: template.format_map(replacements)
+        for key, template in load_catalogs()[lang].items()
+    }
 
-    interpolated_translations = {}
-    for key, value in translations["weblate"].items():
-        match = re.search(replace_pattern, value)
-        while match:
-            value = value.replace(
-                match.group(0), str(replacements[match.group("name")])
-            )
-            match = re.search(replace_pattern, value)
 
-        interpolated_translations[key] = value
+def negotiate(*langs):
+    """
+    returns the first supported language or the default one
 
-    return interpolated_translations
+    Parameters
+    ----------
+    *args : str
+        language tags in order of preference, e.g. from Accept-Language
+    """
+    for lang in langs:
+        supported = _resolve(lang)
+        if supported:
+            return supported
+    return DEFAULT_LANGUAGE
+
+
+@functools.lru_cache(maxsize=1024)
+def _resolve(lang):
+    """
+    returns the catalog for a language tag, 'pt-BR' -> 'pt_BR' -> 'pt',
+    or None if there is none
+    """
+    if not lang:
+        return None
+    catalogs = {l.lower(): l for l in load_catalogs()}
+    tag = lang.replace("-", "_").lower()
+    parts = tag.split("_")
+    while parts:
+        supported = catalogs.get("_".join(parts))
+        if supported:
+            return supported
+        parts.pop()
+    # 'pt' -> 'pt_BR', only for a bare primary tag. A requested script or
+    # region is never swapped for another one, 'zh-Hant-TW' isn't 'zh_Hans'
+    if "_" in tag:
+        return None
+    regional = sorted(k for k in catalogs if k.startswith(tag + "_"))
+    return catalogs[regional[0]] if regional else None
+
+
+@functools.lru_cache(maxsize=None)
+def load_catalogs():
+    """
+    loads all translations once
+
+    the strings are compiled to format strings and every language is
+    completed with the english strings.
+    """
+    directory = os.path.join(__location__, "translations")
+    catalogs = {}
+    for filename in os.listdir(directory):
+        match = catalog_pattern.match(filename)
+        if not match:
+            continue
+        with open(os.path.join(directory, filename), "r") as stream:
+            translations = yaml.load(stream, Loader=yaml.SafeLoader)
+        catalogs[match.group("lang")] = {
+            key: _compile(value) for key, value in translations["weblate"].items()
+        }
+    default = catalogs[DEFAULT_LANGUAGE]
+    return {lang: {**default, **catalog} for lang, catalog in catalogs.items()}
+
+
+def _compile(value):
+    """
+    turns '{{ name }}' placeholders into a format string
+    """
+    parts = replace_pattern.split(str(value))
+    # split returns the text between placeholders and their names in turns
+    return "".join(
+        "{%s}" % part if i % 2 else part.replace("{", "{{").replace("}", "}}")
+        for i, part in enumerate(parts)
+    )
@@ -45,7 +45,7 @@ setuptools.setup(
                                           'static/images/*.jpg',
                                           'static/images/*.png',
                                           'static/images/*.ico']},
-    python_requires='~=3.7',
+    python_requires='>=3.10',
     install_requires=[
         "alembic>=1.8",
         "appdirs>=1.4.4",
@@ -53,7 +53,9 @@ setuptools.setup(
         "Flask-SQLAlchemy>=2.5.1",
         "flask-cors>=3.0.10",
         "flask-httpauth>=4.7.0",
-        "flask-limiter>=2.6",
+        # limiter.Limiter relies on internals of these versions
+        "flask-limiter>=4,<5",
+        "limits>=5,<6",
         "PyYAML>=6.0",
         "jsonschema>=4.17",
         "requests>=2.28",
@@ -64,15 +66,18 @@ setuptools.setup(
     tests_require=test_requirements,
     extras_require={
         "postgres":  ["psycopg2-binary>=2.8.4"],
+        "asgi": ["asgiref>=3.5", "httpx>=0.23", "uvicorn>=0.18"],
+        "brotli": ["brotli>=1.0"],
+        "redis": ["limits[redis]"],
         "testing": test_requirements
     },
     classifiers=[
         "Development Status :: 4 - Beta",
         "Topic :: Communications :: Chat",
         "License :: OSI Approved :: MIT License",
-        "Programming Language :: Python :: 3.7",
-        "Programming Language :: Python :: 3.8",
-        "Programming Language :: Python :: 3.9"
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12"
     ],
     entry_points={
         'console_scripts': [
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 # Standard library imports...
+import asyncio
+import gzip
 import hashlib
 import hmac
 import json
@@ -7,15 +9,22 @@ import logging.config
 import os
 import random
 import re
+import shutil
 import string
 import sys
+import threading
+import time
 import unittest
 from datetime import datetime
 from unittest.mock import patch
-from urllib.parse import urlparse
+from urllib.parse import parse_qs, urlparse
 
 # Third-party imports...
 import yaml
+from click.testing import CliRunner
+from flask import render_template
+from limits.storage import MemoryStorage
+from limits.strategies import MovingWindowRateLimiter
 from parameterized import parameterized
 from requests import exceptions
 
@@ -24,13 +33,21 @@ try:
     from .context import matrix_registration
 except ModuleNotFoundError:
     from context import matrix_registration
+from matrix_registration.assets import IMMUTABLE, Assets
 from matrix_registration.config import Config
+from matrix_registration.limiter import limiter
 from matrix_registration.tokens import db
 from matrix_registration.app import (
     create_app,
     cli,
 )
 
+try:
+    import httpx
+    from matrix_registration.asgi import RegistrationApp
+except ImportError:
+    httpx = None
+
 logger = logging.getLogger(__name__)
 
 LOGGING = {
@@ -66,6 +83,7 @@ GOOD_CONFIG = {
     "username": {
         "validation_regex": ["[a-z\d]"],
         "invalidation_regex": [".*?(admin|support).*?"],
+        "check_availability": False,
     },
     "ip_logging": False,
     "logging": LOGGING,
@@ -179,6 +197,32 @@ def mocked_requests_post(*args, **kwargs):
     return MockResponse(None, 404)
 
 
+class SharedStorage(MemoryStorage):
+    """
+    in-process stand-in for a storage shared by all workers, like redis
+    """
+
+    STORAGE_SCHEME = ["shared"]
+    state = None
+    down = False
+
+    def __init__(self, uri, **options):
+        if SharedStorage.state is None:
+            super().__init__(uri, **options)
+            SharedStorage.state = self.__dict__
+        self.__dict__ = SharedStorage.state
+
+    def incr(self, *args, **kwargs):
+        if self.down:
+            raise ConnectionError("storage is down")
+        return super().incr(*args, **kwargs)
+
+    def acquire_entry(self, *args, **kwargs):
+        if self.down:
+            raise ConnectionError("storage is down")
+        return super().acquire_entry(*args, **kwargs)
+
+
 class TokensTest(unittest.TestCase):
     def setUp(self):
         matrix_registration.config.config = Config(data=GOOD_CONFIG)
@@ -202,6 +246,35 @@ class TokensTest(unittest.TestCase):
             words = re.sub("([a-z])([A-Z])", r"\1 \2", string).split()
             self.assertEqual(len(words), n)
 
+    def test_name_generator(self):
+        wordlist = "tests/wordlist.txt"
+        with open(wordlist, "w") as f:
+            f.write("alpha\nbeta\n\nGamma\nno-dash\n")
+
+        try:
+            generate_name = matrix_registration.tokens.NameGenerator(
+                length=2, wordlist=wordlist
+            )
+            self.assertEqual(generate_name.words, ("Alpha", "Beta", "Gamma"))
+            self.assertRegex(generate_name(), r"^([A-Z][a-z]+){2}$")
+
+            # the wordlist is only read once
+            with patch("builtins.open") as mock_open:
+                matrix_registration.tokens.NameGenerator(wordlist=wordlist)
+                mock_open.assert_not_called()
+
+            # taken names are skipped
+            taken = {a + b for a in generate_name.words for b in generate_name.words}
+            taken.remove("GammaAlpha")
+            self.assertEqual(
+                generate_name(exists=taken.__contains__, attempts=1000), "GammaAlpha"
+            )
+            taken.add("GammaAlpha")
+            with self.assertRaises(RuntimeError):
+                generate_name(exists=taken.__contains__)
+        finally:
+            os.remove(wordlist)
+
     def test_tokens_empty(self):
         with self.app.app_context():
             test_tokens = matrix_registration.tokens.Tokens()
@@ -230,7 +303,7 @@ class TokensTest(unittest.TestCase):
             self.assertFalse(test_tokens.active(test_token2.name))
 
             test_token3 = test_tokens.new()
-            test_token3.use()
+            self.assertTrue(test_tokens.use(test_token3.name))
 
             self.assertFalse(test_tokens.active(test_token2.name))
             self.assertFalse(test_tokens.disable(test_token2.name))
@@ -288,6 +361,39 @@ class TokensTest(unittest.TestCase):
                 test_token5.active(), test_tokens.get_token(test_token5.name).active()
             )
 
+    def test_tokens_cache(self):
+        with self.app.app_context():
+            test_tokens = matrix_registration.tokens.Tokens()
+            other_tokens = matrix_registration.tokens.Tokens()
+
+            test_token = test_tokens.new(max_usage=True)
+            test_token2 = test_tokens.new()
+            generation = test_tokens.generation
+
+            # changes of another instance are picked up by comparing generations
+            self.assertTrue(other_tokens.known(test_token.name))
+            other_tokens.refresh()
+            self.assertEqual(other_tokens.generation, generation)
+
+            # usages don't touch the generation, active reads the token itself
+            self.assertTrue(other_tokens.active(test_token.name))
+            test_tokens.use(test_token.name)
+            self.assertFalse(other_tokens.active(test_token.name))
+            other_tokens.refresh()
+            self.assertEqual(other_tokens.generation, generation)
+
+            # only rows newer than the cached generation are fetched
+            with patch.object(other_tokens, "load") as mock_load:
+                test_tokens.disable(test_token2.name)
+                self.assertFalse(other_tokens.active(test_token2.name))
+                mock_load.assert_not_called()
+
+            # deletions invalidate the whole cache
+            test_tokens.delete(test_token2.name)
+            self.assertFalse(other_tokens.active(test_token2.name))
+            self.assertNotIn(test_token2.name, other_tokens.tokens)
+            self.assertIn(test_token.name, other_tokens.tokens)
+
     @parameterized.expand(
         [
             [None, False],
@@ -314,6 +420,27 @@ class TokensTest(unittest.TestCase):
                 self.assertFalse(test_token.max_usage)
             self.assertTrue(test_tokens.active(test_token.name))
 
+    def test_tokens_new_batch(self):
+        with self.app.app_context():
+            test_tokens = matrix_registration.tokens.Tokens()
+            test_token = test_tokens.new()
+
+            created = test_tokens.new_batch(
+                200, expiration_date=datetime.fromisoformat("2200-01-12"), max_usage=2
+            )
+            names = [token.name for token in created]
+
+            self.assertEqual(len(set(names)), 200)
+            self.assertNotIn(test_token.name, names)
+            self.assertEqual(matrix_registration.tokens.Token.query.count(), 201)
+            for name in names:
+                self.assertTrue(test_tokens.active(name))
+                self.assertEqual(test_tokens.get_token(name).max_usage, 2)
+
+            with self.assertRaises(ValueError):
+                test_tokens.new_batch(0)
+            self.assertEqual(matrix_registration.tokens.Token.query.count(), 201)
+
     @parameterized.expand(
         [
             [None, False, 10, True],
@@ -343,6 +470,163 @@ class TokensTest(unittest.TestCase):
                 self.assertEqual(test_token.used, 1)
             self.assertEqual(test_tokens.active(test_token.name), active)
 
+    def test_tokens_use_concurrent(self):
+        with self.app.app_context():
+            test_tokens = matrix_registration.tokens.Tokens()
+            test_token = test_tokens.new(max_usage=3)
+            name = test_token.name
+
+        results = []
+
+        def use():
+            with self.app.app_context():
+                results.append(test_tokens.use(name, "127.0.0.1"))
+
+        threads = [threading.Thread(target=use) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with self.app.app_context():
+            # exactly max_usage registrations may succeed
+            self.assertEqual(results.count(True), 3)
+            self.assertEqual(test_tokens.get_token(name).used, 3)
+            self.assertEqual(len(test_tokens.get_token(name).ips), 3)
+            self.assertFalse(test_tokens.active(name))
+
+    def test_tokens_usage_addresses(self):
+        with self.app.app_context():
+            test_tokens = matrix_registration.tokens.Tokens()
+            test_token = test_tokens.new()
+            test_token2 = test_tokens.new()
+
+            test_tokens.use(test_token.name, ["1.2.3.4, 2001:DB8::1", "10.0.0.1"])
+            test_tokens.use(test_token.name, ["::ffff:1.2.3.4", "not an ip"])
+            test_tokens.use(test_token2.name, "1.2.3.4")
+            test_tokens.use(test_token2.name)
+
+            # every address is stored once, packed
+            Address = matrix_registration.tokens.Address
+            self.assertEqual(
+                sorted(a.packed for a in Address.query.all()),
+                sorted(
+                    [
+                        bytes([1, 2, 3, 4]),
+                        bytes([10, 0, 0, 1]),
+                        bytes.fromhex("20010db8000000000000000000000001"),
+                    ]
+                ),
+            )
+            self.assertEqual(
+                test_tokens.get_token(test_token.name).toDict()["ips"],
+                ["1.2.3.4", "2001:db8::1", "10.0.0.1", "1.2.3.4"],
+            )
+            self.assertEqual(
+                test_tokens.get_token(test_token2.name).toDict()["ips"], ["1.2.3.4"]
+            )
+            # one usage per use, its addresses keep their place in the chain
+            usages = test_tokens.get_token(test_token.name).usages
+            self.assertEqual(len(usages), 2)
+            self.assertEqual(
+                [(a.position, str(a.address)) for a in usages[0].addresses],
+                [(0, "1.2.3.4"), (1, "2001:db8::1"), (2, "10.0.0.1")],
+            )
+            # uses without logged addresses are still recorded
+            usages = test_tokens.get_token(test_token2.name).usages
+            self.assertEqual(len(usages), 2)
+            self.assertEqual(usages[1].addresses, [])
+
+            self.assertTrue(test_tokens.delete(test_token.name))
+
+    def test_tokens_known(self):
+        with self.app.app_context():
+            test_tokens = matrix_registration.tokens.Tokens()
+            other_tokens = matrix_registration.tokens.Tokens()
+            test_token = test_tokens.new()
+
+            # unknown tokens are rejected without a query
+            other_tokens.refresh()
+            with patch.object(other_tokens, "_state") as mock_state:
+                self.assertFalse(other_tokens.known("DoubleWizardSki", "1.2.3.4"))
+                self.assertFalse(other_tokens.known("DoubleWizardSky", "1.2.3.4"))
+                self.assertFalse(other_tokens.known("DoubleWizardSki", "5.6.7.8"))
+                mock_state.assert_not_called()
+            self.assertEqual(other_tokens.misses["1.2.3.4"], 2)
+            self.assertEqual(other_tokens.misses["5.6.7.8"], 1)
+
+            # tokens of other instances are found once the cache is stale
+            test_token2 = test_tokens.new()
+            self.assertTrue(test_tokens.known(test_token2.name))
+            other_tokens.refreshed_at = 0
+            self.assertTrue(other_tokens.known(test_token2.name))
+            self.assertTrue(other_tokens.known(test_token.name))
+
+    def test_tokens_lease(self):
+        with self.app.app_context():
+            test_tokens = matrix_registration.tokens.Tokens()
+            test_token = test_tokens.new(max_usage=True)
+
+            # a lease holds the only usage until it is confirmed or released
+            lease = test_tokens.reserve(test_token.name)
+            self.assertIsNotNone(lease)
+            self.assertFalse(test_tokens.active(test_token.name))
+            self.assertIsNone(test_tokens.reserve(test_token.name))
+
+            self.assertTrue(test_tokens.release(lease, test_token.name))
+            self.assertTrue(test_tokens.active(test_token.name))
+            self.assertFalse(test_tokens.release(lease, test_token.name))
+
+            lease = test_tokens.reserve(test_token.name)
+            self.assertTrue(test_tokens.confirm(lease, test_token.name, "127.0.0.1"))
+            self.assertFalse(test_tokens.active(test_token.name))
+            self.assertEqual(test_tokens.get_token(test_token.name).used, 1)
+            self.assertEqual(len(test_tokens.get_token(test_token.name).ips), 1)
+
+    def test_tokens_lease_expired(self):
+        with self.app.app_context():
+            test_tokens = matrix_registration.tokens.Tokens()
+            test_token = test_tokens.new(max_usage=True)
+
+            # expired leases are given back on the next reservation
+            lease = test_tokens.reserve(test_token.name, ttl=-1)
+            lease2 = test_tokens.reserve(test_token.name)
+            self.assertIsNotNone(lease2)
+
+            # confirming a reclaimed lease uses the token again, if possible
+            self.assertFalse(test_tokens.confirm(lease, test_token.name))
+            self.assertTrue(test_tokens.confirm(lease2, test_token.name))
+            self.assertEqual(test_tokens.get_token(test_token.name).used, 1)
+
+            # and before checking if the token is active
+            test_token2 = test_tokens.new(max_usage=True)
+            lease = test_tokens.reserve(test_token2.name, ttl=-1)
+            self.assertTrue(test_tokens.active(test_token2.name))
+            self.assertFalse(test_tokens.release(lease, test_token2.name))
+
+    def test_tokens_active_sql(self):
+        with self.app.app_context():
+            test_tokens = matrix_registration.tokens.Tokens()
+            test_tokens.new()
+            test_tokens.disable(test_tokens.new().name)
+            test_tokens.new(expiration_date=datetime.fromisoformat("2000-01-01"))
+            test_tokens.new(expiration_date=datetime.fromisoformat("2200-01-01"))
+            test_tokens.use(test_tokens.new(max_usage=1).name)
+            test_tokens.use(test_tokens.new(max_usage=2).name)
+
+            # the sql expression agrees with the python implementation
+            Token = matrix_registration.tokens.Token
+            active = sorted(t.name for t in Token.query.all() if t.is_active)
+            self.assertEqual(len(active), 3)
+            self.assertEqual(test_tokens.names(active=True), active)
+            self.assertEqual(
+                sorted(t.name for t in Token.query.filter(Token.is_active)), active
+            )
+            self.assertEqual(test_tokens.count(), 6)
+            self.assertEqual(test_tokens.count(active=True), 3)
+            self.assertEqual(test_tokens.count(active=False, disabled=False), 2)
+            self.assertEqual(test_tokens.count(expired=True), 1)
+
     @parameterized.expand(
         [
             [None, True],
@@ -439,7 +723,8 @@ class ApiTest(unittest.TestCase):
     # check form activeators
     @patch("matrix_registration.matrix_api._get_nonce", side_effect=mocked__get_nonce)
     @patch(
-        "matrix_registration.matrix_api.requests.post", side_effect=mocked_requests_post
+        "matrix_registration.matrix_api.requests.Session.post",
+        side_effect=mocked_requests_post,
     )
     def test_register(
             self, username, password, confirm, token, status, mock_get, mock_nonce
@@ -475,7 +760,36 @@ class ApiTest(unittest.TestCase):
 
     @patch("matrix_registration.matrix_api._get_nonce", side_effect=mocked__get_nonce)
     @patch(
-        "matrix_registration.matrix_api.requests.post", side_effect=mocked_requests_post
+        "matrix_registration.matrix_api.requests.Session.post",
+        side_effect=mocked_requests_post,
+    )
+    def test_register_expired_lease(self, mock_post, mock_nonce):
+        matrix_registration.config.config = Config(data=GOOD_CONFIG)
+        with self.app.app_context():
+            matrix_registration.tokens.tokens = matrix_registration.tokens.Tokens()
+            test_token = matrix_registration.tokens.tokens.new(max_usage=True)
+            # a registration that died before confirming or releasing its lease
+            matrix_registration.tokens.tokens.reserve(test_token.name, ttl=-1)
+
+            rv = self.client.post(
+                "/register",
+                data=dict(
+                    username="test",
+                    password="test1234",
+                    confirm="test1234",
+                    token=test_token.name,
+                ),
+            )
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(matrix_registration.tokens.TokenLease.query.count(), 0)
+            self.assertEqual(
+                matrix_registration.tokens.tokens.get_token(test_token.name).used, 1
+            )
+
+    @patch("matrix_registration.matrix_api._get_nonce", side_effect=mocked__get_nonce)
+    @patch(
+        "matrix_registration.matrix_api.requests.Session.post",
+        side_effect=mocked_requests_post,
     )
     def test_register_wrong_hs(self, mock_get, mock_nonce):
         matrix_registration.config.config = Config(data=BAD_CONFIG1)
@@ -495,10 +809,13 @@ class ApiTest(unittest.TestCase):
                 ),
             )
             self.assertEqual(rv.status_code, 500)
+            # the reserved usage is given back if the hs fails
+            self.assertTrue(matrix_registration.tokens.tokens.active(test_token.name))
 
     @patch("matrix_registration.matrix_api._get_nonce", side_effect=mocked__get_nonce)
     @patch(
-        "matrix_registration.matrix_api.requests.post", side_effect=mocked_requests_post
+        "matrix_registration.matrix_api.requests.Session.post",
+        side_effect=mocked_requests_post,
     )
     def test_register_wrong_secret(self, mock_get, mock_nonce):
         matrix_registration.config.config = Config(data=BAD_CONFIG3)
@@ -519,6 +836,311 @@ class ApiTest(unittest.TestCase):
             )
             self.assertEqual(rv.status_code, 500)
 
+    @patch("matrix_registration.matrix_api._get_nonce", side_effect=mocked__get_nonce)
+    @patch(
+        "matrix_registration.matrix_api.requests.Session.post",
+        side_effect=mocked_requests_post,
+    )
+    def test_register_busy(self, mock_post, mock_nonce):
+        matrix_registration.config.config = Config(
+            data=dict(
+                GOOD_CONFIG,
+                homeserver={"max_concurrent": 1, "queue_size": 0},
+            )
+        )
+        matrix_registration.matrix_api._admission_controls.clear()
+        control = matrix_registration.matrix_api.get_admission_control(
+            GOOD_CONFIG["server_location"]
+        )
+        # another registration is waiting for the homeserver
+        control.acquire()
+
+        with self.app.app_context():
+            matrix_registration.tokens.tokens = matrix_registration.tokens.Tokens()
+            test_token = matrix_registration.tokens.tokens.new()
+            rv = self.client.post(
+                "/register",
+                data=dict(
+                    username="busyuser",
+                    password="password",
+                    confirm="password",
+                    token=test_token.name,
+                ),
+            )
+            self.assertEqual(rv.status_code, 503)
+            self.assertEqual(json.loads(rv.data)["errcode"], "MR_HS_BUSY")
+            self.assertEqual(rv.headers["Retry-After"], "1")
+            mock_post.assert_not_called()
+            self.assertTrue(matrix_registration.tokens.tokens.active(test_token.name))
+        matrix_registration.matrix_api._admission_controls.clear()
+
+    def enable_availability_check(self, mock_get):
+        matrix_registration.config.config = Config(
+            data=dict(
+                GOOD_CONFIG,
+                username=dict(GOOD_CONFIG["username"], check_availability=True),
+            )
+        )
+        matrix_registration.matrix_api._usernames = None
+
+        def get(url, **kwargs):
+            query = parse_qs(urlparse(url).query)
+            if query["username"] == ["taken"]:
+                response = unittest.mock.Mock(status_code=400)
+                response.json.return_value = {
+                    "errcode": "M_USER_IN_USE",
+                    "error": "User ID already taken.",
+                }
+                response.raise_for_status.side_effect = exceptions.HTTPError(
+                    response=response
+                )
+            else:
+                response = unittest.mock.Mock(status_code=200)
+                response.json.return_value = {"available": True}
+            return response
+
+        mock_get.side_effect = get
+
+    @patch("matrix_registration.matrix_api.requests.Session.get")
+    def test_register_available(self, mock_get):
+        self.enable_availability_check(mock_get)
+        with self.app.app_context():
+            for _ in range(2):
+                rv = self.client.get("/register/available?username=%40taken%3Amatrix.org")
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(
+                    json.loads(rv.data), {"username": "taken", "available": False}
+                )
+                rv = self.client.get("/register/available?username=free")
+                self.assertEqual(
+                    json.loads(rv.data), {"username": "free", "available": True}
+                )
+            # answers are cached
+            self.assertEqual(mock_get.call_count, 2)
+            self.assertTrue(
+                mock_get.call_args.args[0].startswith(
+                    "%s/_matrix/client/v3/register/available?"
+                    % GOOD_CONFIG["server_location"]
+                )
+            )
+
+            # invalid usernames never reach the homeserver
+            rv = self.client.get("/register/available?username=admin")
+            self.assertEqual(rv.status_code, 400)
+            self.assertIn("username", json.loads(rv.data)["error"])
+            rv = self.client.get("/register/available")
+            self.assertEqual(rv.status_code, 400)
+            self.assertEqual(mock_get.call_count, 2)
+        matrix_registration.matrix_api._usernames = None
+
+    @patch("matrix_registration.matrix_api._get_nonce", side_effect=mocked__get_nonce)
+    @patch(
+        "matrix_registration.matrix_api.requests.Session.post",
+        side_effect=mocked_requests_post,
+    )
+    @patch("matrix_registration.matrix_api.requests.Session.get")
+    def test_register_username_taken(self, mock_get, mock_post, mock_nonce):
+        self.enable_availability_check(mock_get)
+        with self.app.app_context():
+            matrix_registration.tokens.tokens = matrix_registration.tokens.Tokens()
+            test_token = matrix_registration.tokens.tokens.new()
+            data = dict(password="password", confirm="password", token=test_token.name)
+
+            rv = self.client.post("/register", data=dict(data, username="taken"))
+            self.assertEqual(rv.status_code, 400)
+            self.assertEqual(json.loads(rv.data)["errcode"], "M_USER_IN_USE")
+            mock_post.assert_not_called()
+            self.assertTrue(matrix_registration.tokens.tokens.active(test_token.name))
+
+            rv = self.client.post("/register", data=dict(data, username="freeuser"))
+            self.assertEqual(rv.status_code, 200)
+            mock_post.assert_called_once()
+            # the new account is remembered as taken
+            rv = self.client.get("/register/available?username=freeuser")
+            self.assertFalse(json.loads(rv.data)["available"])
+        matrix_registration.matrix_api._usernames = None
+
+    @patch("matrix_registration.matrix_api._get_nonce", side_effect=mocked__get_nonce)
+    @patch(
+        "matrix_registration.matrix_api.requests.Session.post",
+        side_effect=mocked_requests_post,
+    )
+    def test_register_breached_password(self, mock_post, mock_nonce):
+        path = "tests/breached.bin"
+        digest = hashlib.sha1(b"password").hexdigest()
+        matrix_registration.sortedfile.write_hash_file([digest], path)
+        matrix_registration.config.config = Config(
+            data=dict(
+                GOOD_CONFIG, password={"min_length": 8, "breached_hashes_file": path}
+            )
+        )
+        with self.app.app_context():
+            matrix_registration.tokens.tokens = matrix_registration.tokens.Tokens()
+            test_token = matrix_registration.tokens.tokens.new()
+            for password, status in [("password", 400), ("drowssap", 200)]:
+                rv = self.client.post(
+                    "/register",
+                    data=dict(
+                        username="breached%s" % status,
+                        password=password,
+                        confirm=password,
+                        token=test_token.name,
+                    ),
+                )
+                self.assertEqual(rv.status_code, status)
+            self.assertEqual(mock_post.call_count, 1)
+        matrix_registration.config.config.breached_hashes.close()
+        os.remove(path)
+
+    def test_get_register_cached(self):
+        with patch(
+            "matrix_registration.api.render_template", wraps=render_template
+        ) as mock_render:
+            rv = self.client.get("/register", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.headers["Content-Encoding"], "gzip")
+            self.assertEqual(rv.headers["Cache-Control"], "public, max-age=300")
+            self.assertIn("Accept-Language", rv.headers["Vary"])
+            page = gzip.decompress(rv.data).decode("utf8")
+            self.assertIn("matrix.org registration", page)
+            etag = rv.headers["ETag"]
+
+            rv = self.client.get("/register")
+            self.assertIsNone(rv.headers.get("Content-Encoding"))
+            self.assertEqual(rv.data.decode("utf8"), page)
+            self.assertNotEqual(rv.headers["ETag"], etag)
+
+            rv = self.client.get(
+                "/register",
+                headers={"Accept-Encoding": "gzip", "If-None-Match": etag},
+            )
+            self.assertEqual(rv.status_code, 304)
+            self.assertEqual(rv.data, b"")
+            self.assertEqual(mock_render.call_count, 1)
+
+            # reloading the config renders the page again
+            config = dict(GOOD_CONFIG, server_name="example.org")
+            matrix_registration.config.config.update(config)
+            rv = self.client.get("/register", headers={"If-None-Match": etag})
+            self.assertEqual(rv.status_code, 200)
+            self.assertIn("example.org registration", rv.data.decode("utf8"))
+            self.assertEqual(mock_render.call_count, 2)
+
+    @parameterized.expand([[False], [True]])
+    def test_get_register_availability(self, check_availability):
+        matrix_registration.config.config = Config(
+            data=dict(
+                GOOD_CONFIG,
+                username=dict(
+                    GOOD_CONFIG["username"], check_availability=check_availability
+                ),
+            )
+        )
+        page = self.client.get("/register").data.decode("utf8")
+        # the page only asks for usernames the server would check anyway
+        self.assertEqual("/register/available" in page, check_availability)
+
+    def test_static_assets(self):
+        page = self.client.get("/register").data.decode("utf8")
+        url = re.search(r"/static/css/style\.[0-9a-f]{12}\.css", page).group(0)
+        with open("matrix_registration/static/css/style.css", "rb") as f:
+            style = f.read()
+
+        rv = self.client.get(url, headers={"Accept-Encoding": "gzip, br;q=0"})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers["Content-Encoding"], "gzip")
+        self.assertEqual(rv.headers["Cache-Control"], IMMUTABLE)
+        self.assertEqual(rv.mimetype, "text/css")
+        self.assertEqual(gzip.decompress(rv.data), style)
+
+        rv = self.client.get(
+            url,
+            headers={"Accept-Encoding": "gzip", "If-None-Match": rv.headers["ETag"]},
+        )
+        self.assertEqual(rv.status_code, 304)
+
+        # the plain names still work, but have to be revalidated
+        rv = self.client.get("/static/css/style.css")
+        self.assertEqual(rv.data, style)
+        self.assertEqual(rv.headers["Cache-Control"], "no-cache")
+
+        rv = self.client.get("/static/css/style.000000000000.css")
+        self.assertEqual(rv.status_code, 404)
+
+    def test_client_logo(self):
+        logo = "static/images/element-logo.png"
+        matrix_registration.config.config.update(dict(GOOD_CONFIG, client_logo=logo))
+        page = self.client.get("/register").data.decode("utf8")
+        url = re.search(r'src="([^"]+element-logo\.png\?v=\w{12})"', page).group(1)
+        rv = self.client.get(url)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, "image/png")
+        self.assertEqual(rv.headers["Cache-Control"], IMMUTABLE)
+        with open("matrix_registration/" + logo, "rb") as f:
+            self.assertEqual(rv.data, f.read())
+
+        rv = self.client.get("/static/replace/images/element-logo.png")
+        self.assertEqual(rv.headers["Cache-Control"], "no-cache")
+
+        matrix_registration.config.config.update(dict(GOOD_CONFIG, client_logo=""))
+        rv = self.client.get("/static/replace/images/element-logo.png")
+        self.assertEqual(rv.status_code, 404)
+
+    @parameterized.expand(
+        [
+            [None, "pt-BR,en;q=0.5", "Registro no matrix.org"],
+            [None, "xx, de-AT;q=0.8", "matrix.org Registrierung"],
+            ["zh-hans", "de", "matrix.org"],
+            ["../../../etc/passwd", None, "matrix.org registration"],
+        ]
+    )
+    def test_get_register_language(self, lang, accept_language, title):
+        matrix_registration.translation.load_catalogs()
+        headers = {"Accept-Language": accept_language} if accept_language else {}
+        with patch("matrix_registration.translation.yaml.load") as mock_load:
+            rv = self.client.get(
+                "/register",
+                query_string={"lang": lang} if lang else {},
+                headers=headers,
+            )
+            # the catalogs are only parsed once
+            mock_load.assert_not_called()
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(title, rv.data.decode("utf8"))
+
+    @patch("matrix_registration.matrix_api._get_nonce", side_effect=mocked__get_nonce)
+    @patch(
+        "matrix_registration.matrix_api.requests.Session.post",
+        side_effect=exceptions.ConnectionError(),
+    )
+    def test_register_hs_unavailable(self, mock_post, mock_nonce):
+        matrix_registration.config.config = Config(
+            data=dict(GOOD_CONFIG, server_location="https://down.matrix.org")
+        )
+        matrix_registration.matrix_api._breakers.clear()
+
+        with self.app.app_context():
+            matrix_registration.tokens.tokens = matrix_registration.tokens.Tokens()
+            test_token = matrix_registration.tokens.tokens.new()
+            data = dict(
+                username="username",
+                password="password",
+                confirm="password",
+                token=test_token.name,
+            )
+            for _ in range(5):
+                rv = self.client.post("/register", data=data)
+                self.assertEqual(rv.status_code, 500)
+
+            # after repeated failures the homeserver isn't contacted anymore
+            rv = self.client.post("/register", data=data)
+            self.assertEqual(rv.status_code, 503)
+            self.assertEqual(json.loads(rv.data)["errcode"], "MR_HS_UNAVAILABLE")
+            self.assertEqual(rv.headers["Retry-After"], "30")
+            self.assertEqual(mock_post.call_count, 5)
+            self.assertEqual(matrix_registration.tokens.tokens.get_token(test_token.name).used, 0)
+        matrix_registration.matrix_api._breakers.clear()
+
     def test_get_tokens(self):
         matrix_registration.config.config = Config(data=GOOD_CONFIG)
 
@@ -538,6 +1160,53 @@ class ApiTest(unittest.TestCase):
             self.assertEqual(token_data[0]["expiration_date"], None)
             self.assertEqual(token_data[0]["max_usage"], True)
 
+    def test_get_tokens_paginated(self):
+        matrix_registration.config.config = Config(data=GOOD_CONFIG)
+
+        with self.app.app_context():
+            test_tokens = matrix_registration.tokens.Tokens()
+            matrix_registration.tokens.tokens = test_tokens
+            created = sorted(token.name for token in test_tokens.new_batch(25))
+            disabled = test_tokens.new().name
+            test_tokens.disable(disabled)
+            expired = test_tokens.new(
+                expiration_date=datetime.fromisoformat("2000-01-01")
+            ).name
+            used = test_tokens.new(max_usage=2).name
+            test_tokens.use(used)
+
+            secret = matrix_registration.config.config.admin_api_shared_secret
+            headers = {"Authorization": "SharedSecret %s" % secret}
+
+            # keyset pagination follows the link header
+            names = []
+            url = "/api/token?limit=10&active=true"
+            while url:
+                rv = self.client.get(url, headers=headers)
+                self.assertEqual(rv.status_code, 200)
+                names += [token["name"] for token in json.loads(rv.data)]
+                url = rv.headers.get("Link", "")[1:].split(">")[0].replace(
+                    "http://localhost", ""
+                )
+            self.assertEqual(names, sorted(created + [used]))
+
+            def get_names(query):
+                rv = self.client.get("/api/token?" + query, headers=headers)
+                self.assertEqual(rv.status_code, 200)
+                return [token["name"] for token in json.loads(rv.data)]
+
+            self.assertEqual(get_names("disabled=true"), [disabled])
+            self.assertEqual(get_names("expired=1"), [expired])
+            self.assertEqual(get_names("used_gt=0"), [used])
+            self.assertEqual(get_names("active=false&disabled=false"), [expired])
+            self.assertEqual(get_names("prefix=" + created[0]), [created[0]])
+            self.assertEqual(len(get_names("limit=1000")), 28)
+
+            rv = self.client.get("/api/token?active=maybe", headers=headers)
+            self.assertEqual(rv.status_code, 400)
+            rv = self.client.get("/api/token?limit=100000", headers=headers)
+            self.assertEqual(rv.status_code, 400)
+
     def test_error_get_tokens(self):
         matrix_registration.config.config = Config(data=BAD_CONFIG2)
 
@@ -591,6 +1260,56 @@ class ApiTest(unittest.TestCase):
             self.assertEqual(token_data["max_usage"], max_usage)
             self.assertTrue(token_data["name"] is not None)
 
+    @parameterized.expand(
+        [
+            ["application/x-ndjson"],
+            ["text/csv"],
+        ]
+    )
+    def test_post_token_batch(self, mimetype):
+        matrix_registration.config.config = Config(data=GOOD_CONFIG)
+
+        with self.app.app_context():
+            matrix_registration.tokens.tokens = matrix_registration.tokens.Tokens()
+
+            secret = matrix_registration.config.config.admin_api_shared_secret
+            headers = {"Authorization": "SharedSecret %s" % secret, "Accept": mimetype}
+            rv = self.client.post(
+                "/api/token",
+                data=json.dumps(dict(count=50, max_usage=1)),
+                content_type="application/json",
+                headers=headers,
+            )
+
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.mimetype, mimetype)
+            lines = rv.data.decode("utf8").splitlines()
+            if mimetype == "text/csv":
+                self.assertEqual(lines.pop(0).split(",")[0], "name")
+                names = [line.split(",")[0] for line in lines]
+            else:
+                names = [json.loads(line)["name"] for line in lines]
+            self.assertEqual(len(set(names)), 50)
+            for name in names:
+                self.assertTrue(matrix_registration.tokens.tokens.active(name))
+
+            rv = self.client.post(
+                "/api/token",
+                data=json.dumps(dict(count=0)),
+                content_type="application/json",
+                headers=headers,
+            )
+            self.assertEqual(rv.status_code, 400)
+
+            rv = self.client.post(
+                "/api/token",
+                data=json.dumps(dict(count=3, max_usage="many")),
+                content_type="application/json",
+                headers=headers,
+            )
+            self.assertEqual(rv.status_code, 400)
+            self.assertEqual(json.loads(rv.data)["errcode"], "MR_BAD_USER_REQUEST")
+
     def test_error_post_token(self):
         matrix_registration.config.config = Config(data=BAD_CONFIG2)
 
@@ -831,6 +1550,38 @@ class ApiTest(unittest.TestCase):
             self.assertEqual(token_data["errcode"], "MR_BAD_SECRET")
             self.assertEqual(token_data["error"], "wrong shared secret")
 
+    def test_stats(self):
+        matrix_registration.config.config = Config(data=GOOD_CONFIG)
+
+        with self.app.app_context():
+            matrix_registration.tokens.tokens = matrix_registration.tokens.Tokens()
+            test_token = matrix_registration.tokens.tokens.new()
+            matrix_registration.tokens.tokens.disable(
+                matrix_registration.tokens.tokens.new().name
+            )
+
+            for _ in range(3):
+                rv = self.client.post(
+                    "/register",
+                    data=dict(
+                        username="test",
+                        password="test1234",
+                        confirm="test1234",
+                        token="DoubleWizardSki",
+                    ),
+                    headers={"X-Forwarded-For": "1.2.3.4"},
+                )
+                self.assertEqual(rv.status_code, 400)
+
+            secret = matrix_registration.config.config.admin_api_shared_secret
+            headers = {"Authorization": "SharedSecret %s" % secret}
+            rv = self.client.get("/api/stats", headers=headers)
+            self.assertEqual(rv.status_code, 200)
+            stats = json.loads(rv.data.decode("utf8"))
+            self.assertEqual(stats["tokens"], {"total": 2, "active": 1})
+            self.assertEqual(stats["token_misses"]["total"], 3)
+            self.assertEqual(stats["token_misses"]["clients"], {"1.2.3.4": 3})
+
     def test_rate_limit_exempt(self):
         matrix_registration.config.config = Config(data=GOOD_CONFIG)
 
@@ -851,6 +1602,429 @@ class ApiTest(unittest.TestCase):
             rv = self.client.get("/health")
             self.assertEqual(rv.status_code, 200)
 
+    def test_rate_limit_routes(self):
+        matrix_registration.config.config = Config(
+            data=dict(
+                GOOD_CONFIG,
+                rate_limit=["3 per minute"],
+                client_logo="static/images/element-logo.png",
+            )
+        )
+        for i in range(5):
+            rv = self.client.get("/static/css/style.css")
+            self.assertEqual(rv.status_code, 200)
+            rv = self.client.get("/static/replace/images/element-logo.png")
+            self.assertEqual(rv.status_code, 200)
+        for i in range(3):
+            self.assertEqual(self.client.get("/register").status_code, 200)
+        self.assertEqual(self.client.get("/register").status_code, 429)
+        # registrations and checking usernames have budgets of their own
+        with self.app.app_context():
+            data = dict(username="limited", password="", confirm="", token="")
+            rv = self.client.post("/register", data=data)
+            self.assertEqual(rv.status_code, 400)
+        rv = self.client.get("/register/available", query_string={"username": "a"})
+        self.assertEqual(rv.status_code, 200)
+
+    def test_rate_limit_invalid_token(self):
+        matrix_registration.config.config = Config(
+            data=dict(GOOD_CONFIG, rate_limit=["20 per minute"])
+        )
+        data = dict(
+            username="guesser",
+            password="password",
+            confirm="password",
+            token="GuessedToken",
+        )
+        with self.app.app_context():
+            matrix_registration.tokens.tokens = matrix_registration.tokens.Tokens()
+            # a wrong token counts as five requests
+            for i in range(4):
+                rv = self.client.post("/register", data=data)
+                self.assertEqual(rv.status_code, 400)
+            rv = self.client.post("/register", data=data)
+            self.assertEqual(rv.status_code, 429)
+            self.assertEqual(json.loads(rv.data)["errcode"], "M_LIMIT_EXCEEDED")
+            self.assertLessEqual(int(rv.headers["Retry-After"]), 60)
+
+    @patch("matrix_registration.matrix_api._get_nonce", side_effect=mocked__get_nonce)
+    @patch(
+        "matrix_registration.matrix_api.requests.Session.post",
+        side_effect=mocked_requests_post,
+    )
+    def test_rate_limit_registration(self, mock_post, mock_nonce):
+        matrix_registration.config.config = Config(
+            data=dict(GOOD_CONFIG, rate_limits={"registration": ["2 per hour"]})
+        )
+        with self.app.app_context():
+            matrix_registration.tokens.tokens = matrix_registration.tokens.Tokens()
+            test_token = matrix_registration.tokens.tokens.new()
+            for username in ("budget1", "budget2", "budget3"):
+                rv = self.client.post(
+                    "/register",
+                    data=dict(
+                        username=username,
+                        password="password",
+                        confirm="password",
+                        token=test_token.name,
+                    ),
+                )
+            self.assertEqual(rv.status_code, 429)
+            self.assertEqual(mock_post.call_count, 2)
+            token = matrix_registration.tokens.tokens.get_token(test_token.name)
+            self.assertEqual(token.used, 2)
+
+    def create_app(self, data):
+        matrix_registration.config.config = Config(data=data)
+        app = create_app(testing=True)
+        with app.app_context():
+            app.config.from_mapping(
+                SQLALCHEMY_DATABASE_URI=matrix_registration.config.config.db,
+                SQLALCHEMY_TRACK_MODIFICATIONS=False,
+            )
+            db.init_app(app)
+        return app.test_client()
+
+    def test_rate_limit_storage(self):
+        SharedStorage.state = None
+        options = {"uri": "shared://", "strategy": "moving-window"}
+        config = dict(
+            GOOD_CONFIG, rate_limit=["5 per minute"], rate_limit_storage=options
+        )
+        worker1 = self.create_app(config)
+        self.assertIsInstance(limiter.limiter, MovingWindowRateLimiter)
+        self.assertIsInstance(limiter.storage, SharedStorage)
+        for i in range(3):
+            self.assertEqual(worker1.get("/register").status_code, 200)
+
+        # another worker or node shares the counters
+        worker2 = self.create_app(config)
+        for i in range(2):
+            self.assertEqual(worker2.get("/register").status_code, 200)
+        self.assertEqual(worker2.get("/register").status_code, 429)
+
+    @parameterized.expand([[True, 200], [False, 503]])
+    def test_rate_limit_storage_down(self, fail_open, status):
+        options = {"uri": "shared://", "fail_open": fail_open}
+        client = self.create_app(dict(GOOD_CONFIG, rate_limit_storage=options))
+        SharedStorage.down = True
+        try:
+            rv = client.get("/register")
+        finally:
+            SharedStorage.down = False
+        self.assertEqual(rv.status_code, status)
+        if not fail_open:
+            data = json.loads(rv.data.decode("utf8"))
+            self.assertEqual(data["errcode"], "MR_RATE_LIMIT_UNAVAILABLE")
+
+
+class MatrixApiTest(unittest.TestCase):
+    def setUp(self):
+        matrix_registration.config.config = Config(data=GOOD_CONFIG)
+        matrix_registration.matrix_api._breakers.clear()
+
+    def tearDown(self):
+        matrix_registration.matrix_api._breakers.clear()
+        matrix_registration.matrix_api._balancers.clear()
+
+    def test_load_balancer(self):
+        locations = ("https://hs1.matrix.org", "https://hs2.matrix.org")
+        balancer = matrix_registration.matrix_api.LoadBalancer(locations)
+        self.assertEqual({balancer.choose(), balancer.choose()}, set(locations))
+        with balancer.track(locations[0]):
+            self.assertEqual(balancer.choose(), locations[1])
+            self.assertEqual(balancer.choose(), locations[1])
+
+        balancer = matrix_registration.matrix_api.LoadBalancer(locations, "round_robin")
+        with balancer.track(locations[0]):
+            self.assertNotEqual(balancer.choose(), balancer.choose())
+
+        # endpoints with an open circuit are skipped
+        breaker = matrix_registration.matrix_api.get_circuit_breaker(locations[0])
+        for _ in range(breaker.threshold):
+            breaker.failure()
+        self.assertEqual(balancer.choose(), locations[1])
+        self.assertEqual(balancer.choose(), locations[1])
+        self.assertEqual(list(balancer.attempts()), [locations[1], locations[0]])
+
+    @patch("matrix_registration.matrix_api.time.sleep")
+    @patch("matrix_registration.matrix_api.requests.Session.post")
+    @patch("matrix_registration.matrix_api.requests.Session.get")
+    def test_create_account_endpoints(self, mock_get, mock_post, mock_sleep):
+        locations = ["https://hs1.matrix.org", "https://hs2.matrix.org"]
+        matrix_registration.config.config = Config(
+            data=dict(GOOD_CONFIG, server_location=locations)
+        )
+
+        def get(url, **kwargs):
+            if url.startswith(locations[0]):
+                raise exceptions.ConnectTimeout()
+            response = unittest.mock.Mock(status_code=200)
+            response.json.return_value = {"nonce": "abc"}
+            return response
+
+        mock_get.side_effect = get
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {"user_id": "@user:matrix.org"}
+
+        for _ in range(2):
+            account = matrix_registration.matrix_api.create_account(
+                "user", "password", locations, "coolsharesecret"
+            )
+            self.assertEqual(account["user_id"], "@user:matrix.org")
+            # the nonce is used on the endpoint that issued it
+            self.assertTrue(mock_post.call_args.args[0].startswith(locations[1]))
+            self.assertEqual(mock_post.call_args.kwargs["json"]["nonce"], "abc")
+
+        # every endpoint failed
+        matrix_registration.matrix_api._breakers.clear()
+        mock_get.side_effect = exceptions.ConnectTimeout()
+        with self.assertRaises(exceptions.Timeout):
+            matrix_registration.matrix_api.create_account(
+                "user", "password", locations, "coolsharesecret"
+            )
+
+    def test_admission_control(self):
+        control = matrix_registration.matrix_api.AdmissionControl(
+            "https://matrix.org", limit=1, queue_size=1, queue_timeout=5
+        )
+        control.acquire()
+        admitted = threading.Event()
+
+        def wait():
+            with control.admitted():
+                admitted.set()
+
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        for _ in range(100):
+            if control.waiters:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(control.waiters), 1)
+
+        # the queue is full, so this is rejected without waiting
+        with self.assertRaises(matrix_registration.matrix_api.HomeserverBusy):
+            control.acquire()
+
+        control.release(0.5)
+        waiter.join(5)
+        self.assertTrue(admitted.is_set())
+        self.assertEqual(control.in_flight, 0)
+
+        # waiting for a free slot times out
+        control.queue_timeout = 0.01
+        control.acquire()
+        with self.assertRaises(matrix_registration.matrix_api.HomeserverBusy):
+            control.acquire()
+        self.assertEqual(len(control.waiters), 0)
+        self.assertEqual(control.in_flight, 1)
+
+    def test_admission_control_async(self):
+        control = matrix_registration.matrix_api.AdmissionControl(
+            "https://matrix.org", limit=1, queue_size=1, queue_timeout=5
+        )
+
+        async def register():
+            async with control.admitted_async():
+                await asyncio.sleep(0.01)
+
+        async def main():
+            await asyncio.gather(register(), register())
+
+        asyncio.run(main())
+        self.assertEqual(control.in_flight, 0)
+        self.assertEqual(len(control.waiters), 0)
+
+    def test_admission_control_async_cancelled(self):
+        control = matrix_registration.matrix_api.AdmissionControl(
+            "https://matrix.org", limit=1, queue_size=2, queue_timeout=5
+        )
+
+        async def main():
+            await control.acquire_async()
+            # cancelled while still waiting
+            waiting = asyncio.ensure_future(control.acquire_async())
+            await asyncio.sleep(0)
+            self.assertEqual(len(control.waiters), 1)
+            waiting.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+            self.assertEqual(len(control.waiters), 0)
+
+            # cancelled after the slot was handed over
+            waiting = asyncio.ensure_future(control.acquire_async())
+            await asyncio.sleep(0)
+            control.release(0.1)
+            waiting.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+
+        asyncio.run(main())
+        self.assertEqual(control.in_flight, 0)
+        self.assertEqual(len(control.waiters), 0)
+
+    def test_admission_control_adaptive(self):
+        control = matrix_registration.matrix_api.AdmissionControl(
+            "https://matrix.org",
+            limit=10,
+            queue_size=1,
+            queue_timeout=5,
+            target_latency=1,
+        )
+        for _ in range(3):
+            control.acquire()
+            control.release(2)
+        self.assertEqual(control.limit, 7)
+        for _ in range(30):
+            control.acquire()
+            control.release(0.5)
+        self.assertEqual(control.limit, 10)
+
+        # a limit of 0 admits everything
+        control = matrix_registration.matrix_api.AdmissionControl(
+            "https://matrix.org", limit=0, queue_size=0, queue_timeout=0
+        )
+        for _ in range(100):
+            control.acquire()
+        self.assertEqual(control.in_flight, 100)
+
+    def test_circuit_breaker(self):
+        breaker = matrix_registration.matrix_api.CircuitBreaker(
+            "https://matrix.org", threshold=2, reset_timeout=30
+        )
+        with patch("matrix_registration.matrix_api.time.monotonic") as mock_time:
+            mock_time.return_value = 100
+            breaker.before_call()
+            breaker.failure()
+            self.assertEqual(breaker.state, "closed")
+            breaker.failure()
+            self.assertEqual(breaker.state, "open")
+
+            # fail fast while open
+            mock_time.return_value = 110
+            with self.assertRaises(
+                matrix_registration.matrix_api.HomeserverUnavailable
+            ) as cm:
+                breaker.before_call()
+            self.assertEqual(cm.exception.retry_after, 20)
+
+            # only a single probe is let through when half open
+            mock_time.return_value = 131
+            self.assertEqual(breaker.state, "half-open")
+            breaker.before_call()
+            with self.assertRaises(matrix_registration.matrix_api.HomeserverUnavailable):
+                breaker.before_call()
+            breaker.failure()
+            self.assertEqual(breaker.state, "open")
+
+            mock_time.return_value = 162
+            breaker.before_call()
+            breaker.success()
+            self.assertEqual(breaker.state, "closed")
+            breaker.before_call()
+
+    @patch("matrix_registration.matrix_api.requests.Session.get")
+    def test_circuit_breaker_abandoned_probe(self, mock_get):
+        matrix_registration.matrix_api._breakers.clear()
+        breaker = matrix_registration.matrix_api.get_circuit_breaker(
+            "https://matrix.org"
+        )
+        breaker.opened_at = time.monotonic() - breaker.reset_timeout
+        self.assertEqual(breaker.state, "half-open")
+
+        # a probe that ends without an answer doesn't block the next one
+        mock_get.side_effect = KeyboardInterrupt
+        with self.assertRaises(KeyboardInterrupt):
+            matrix_registration.matrix_api._get_nonce("https://matrix.org")
+        self.assertFalse(breaker.probing)
+        self.assertTrue(breaker.before_call())
+        breaker.abandon_probe()
+
+        # neither does one of a plan that is dropped halfway
+        plan = matrix_registration.matrix_api.nonce_plan("https://matrix.org")
+        next(plan)
+        self.assertTrue(breaker.probing)
+        plan.close()
+        self.assertFalse(breaker.probing)
+        matrix_registration.matrix_api._breakers.clear()
+
+    @patch("matrix_registration.matrix_api._get_nonce", side_effect=mocked__get_nonce)
+    def test_nonce_pool(self, mock_nonce):
+        pool = matrix_registration.matrix_api.NoncePool(
+            "https://matrix.org", size=2, ttl=50
+        )
+        pool.nonces.append((time.monotonic() - 60, "old"))
+
+        # expired nonces are never handed out
+        self.assertIsNone(pool.get())
+        for _ in range(100):
+            if len(pool.nonces) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(pool.nonces), 2)
+        self.assertEqual(mock_nonce.call_count, 2)
+
+        nonce = pool.get()
+        self.assertIn(nonce, nonces)
+        self.assertNotEqual(nonce, "old")
+        for _ in range(100):
+            if mock_nonce.call_count == 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual(mock_nonce.call_count, 3)
+
+    @patch("matrix_registration.matrix_api.requests.Session.get")
+    def test_nonce_pool_failure(self, mock_get):
+        mock_get.side_effect = exceptions.ConnectionError()
+        pool = matrix_registration.matrix_api.NoncePool(
+            "https://matrix.org", size=2, ttl=50
+        )
+        with patch("matrix_registration.matrix_api.time.sleep"):
+            self.assertIsNone(pool.get())
+            pool._thread.join(5)
+        # the thread gives up and is restarted by the next registration
+        self.assertFalse(pool._thread.is_alive())
+        self.assertEqual(len(pool.nonces), 0)
+
+    @patch("matrix_registration.matrix_api.time.sleep")
+    @patch("matrix_registration.matrix_api.requests.Session.get")
+    def test_get_nonce_retry(self, mock_get, mock_sleep):
+        response = unittest.mock.Mock(status_code=200)
+        response.json.return_value = {"nonce": "abc"}
+        mock_get.side_effect = [exceptions.ConnectionError(), response]
+
+        nonce = matrix_registration.matrix_api._get_nonce("https://matrix.org")
+        self.assertEqual(nonce, "abc")
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(mock_get.call_args.kwargs["timeout"], (5, 30))
+        mock_sleep.assert_called_once()
+
+        # retries are bounded
+        mock_get.reset_mock()
+        mock_get.side_effect = exceptions.ReadTimeout()
+        with self.assertRaises(exceptions.Timeout):
+            matrix_registration.matrix_api._get_nonce("https://matrix.org")
+        self.assertEqual(mock_get.call_count, 3)
+
+    def test_get_session(self):
+        get_session = matrix_registration.matrix_api.get_session
+        session = get_session("https://matrix.org")
+
+        # connections are pooled per homeserver
+        self.assertIs(get_session("https://matrix.org/"), session)
+        self.assertIsNot(get_session("https://wronghs.org"), session)
+        adapter = session.get_adapter("https://matrix.org")
+        self.assertEqual(adapter._pool_maxsize, 10)
+        self.assertEqual(session.headers["Connection"], "keep-alive")
+
+        matrix_registration.config.config = Config(
+            data=dict(GOOD_CONFIG, homeserver={"pool_size": 2, "keep_alive": False})
+        )
+        session = get_session("https://matrix.org")
+        self.assertEqual(session.get_adapter("https://matrix.org")._pool_maxsize, 2)
+        self.assertEqual(session.headers["Connection"], "close")
+
 
 class ConfigTest(unittest.TestCase):
     def test_config_update(self):
@@ -868,6 +2042,143 @@ class ConfigTest(unittest.TestCase):
             BAD_CONFIG1["server_location"],
         )
 
+    def test_token_lease_ttl(self):
+        margin = matrix_registration.config.LEASE_MARGIN
+        # 3 nonce requests with backoff, then the registration itself
+        config = Config(data=GOOD_CONFIG)
+        self.assertEqual(config.token_lease_ttl, 141 + margin)
+
+        # every endpoint may fail to hand out a nonce and registrations queue
+        homeserver = dict(max_concurrent=2, queue_timeout=10, read_timeout=5)
+        config = Config(
+            data=dict(
+                GOOD_CONFIG,
+                server_location=["http://a", "http://b"],
+                homeserver=homeserver,
+            )
+        )
+        self.assertEqual(config.token_lease_ttl, 82 + margin)
+
+        config = Config(data=dict(GOOD_CONFIG, token_lease_ttl=600))
+        self.assertEqual(config.token_lease_ttl, 600)
+        with self.assertRaises(SystemExit):
+            Config(data=dict(GOOD_CONFIG, token_lease_ttl=60))
+
+    @parameterized.expand(
+        [
+            ["user", None],
+            ["@user:matrix.org", None],
+            ["@user:example.com", "mxid pattern"],
+            ["USER", "/[a-z]/"],
+            ["name42", "/^name42$/"],
+            ["administrator", "/adm/"],
+            ["name1001", None],
+            ["support-bot", "/.*?(support|help).*?/"],
+            ["abba", "/(a)(b)\\2\\1/"],
+        ]
+    )
+    def test_username_rules(self, username, error):
+        reserved = ["^name%d$" % i for i in range(1000)]
+        rules = matrix_registration.config.UsernameRules(
+            "matrix.org",
+            ["[a-z]"],
+            reserved + ["admin", "adm", ".*?(support|help).*?", "(a)(b)\\2\\1"],
+        )
+        self.assertEqual(len(rules.reserved), 1000)
+        # 'adm' finds 'admin' already
+        self.assertEqual(rules.words_re.pattern, "adm")
+        result = rules.check(username)
+        if error is None:
+            self.assertIsNone(result)
+        else:
+            self.assertIn(error, result)
+
+    def test_username_blocklist(self):
+        path = "tests/blocklist.sorted"
+        names = sorted(
+            matrix_registration.config.normalize_username("name%d" % i).encode()
+            for i in range(10000)
+        )
+        with open(path, "wb") as f:
+            f.write(b"\n".join([b"admin"] + names + [b"zzz"]))
+        blocklist = matrix_registration.sortedfile.SortedFile(path)
+        for name in [names[0], names[-1], names[5000], b"admin", b"zzz"]:
+            self.assertIn(name, blocklist)
+        for name in [b"", b"a", b"name", b"zzzz", names[5000] + b"0"]:
+            self.assertNotIn(name, blocklist)
+        blocklist.close()
+
+        rules = matrix_registration.config.UsernameRules("matrix.org", [], [], path)
+        for username in [
+            "admin",
+            "@Admin:matrix.org",
+            "a_dmin",
+            "4dmin",
+            "adm1n",
+            "admln",
+            "name42",
+        ]:
+            self.assertEqual(rules.check(username), "Username is reserved")
+        for username in ["administrator", "name", "user"]:
+            self.assertIsNone(rules.check(username))
+        rules.blocklist.close()
+        os.remove(path)
+
+        with open(path, "wb"):
+            pass
+        self.assertNotIn(b"admin", matrix_registration.sortedfile.SortedFile(path))
+        os.remove(path)
+
+    @parameterized.expand([[20], [8]])
+    def test_breached_hashes(self, prefix_length):
+        path = "tests/breached.bin"
+        breached = ["password", "12345678", "hunter2"] + [str(i) for i in range(1000)]
+        lines = sorted(
+            "%s:%d" % (hashlib.sha1(p.encode()).hexdigest().upper(), i)
+            for i, p in enumerate(breached)
+        )
+        count = matrix_registration.sortedfile.write_hash_file(
+            lines, path, prefix_length
+        )
+        self.assertEqual(count, len(breached))
+        self.assertEqual(
+            os.path.getsize(path),
+            matrix_registration.sortedfile.HASH_FILE_HEADER + count * prefix_length,
+        )
+
+        matrix_registration.config.config = Config(
+            data=dict(
+                GOOD_CONFIG, password={"min_length": 8, "breached_hashes_file": path}
+            )
+        )
+        hashes = matrix_registration.config.config.breached_hashes
+        self.assertEqual(len(hashes), len(breached))
+        for password in breached:
+            self.assertIn(hashlib.sha1(password.encode()).digest(), hashes)
+        for password in ["correct horse battery staple", "1000"]:
+            self.assertNotIn(hashlib.sha1(password.encode()).digest(), hashes)
+        hashes.close()
+
+        with self.assertRaises(ValueError):
+            matrix_registration.sortedfile.write_hash_file(lines[::-1], path)
+        os.remove(path)
+
+    @parameterized.expand(
+        [
+            [["pt-BR"], "pt_BR"],
+            [["pt_br"], "pt_BR"],
+            [["pt"], "pt_BR"],
+            [["de-DE"], "de"],
+            [["zh-Hans-CN"], "zh_Hans"],
+            [["zh-Hant-TW", "de"], "de"],
+            [["pt-PT"], "en"],
+            [["xx", "sv"], "sv"],
+            [[None, "xx"], "en"],
+        ]
+    )
+    def test_negotiate(self, langs, expected):
+        self.assertEqual(matrix_registration.translation.negotiate(*langs), expected)
+
     def test_config_path(self):
         # BAD_CONFIG1_path = "x"
         good_config_path = "tests/test_config.yaml"
@@ -880,6 +2191,109 @@ class ConfigTest(unittest.TestCase):
         os.remove(good_config_path)
 
 
+def mocked_homeserver(request):
+    if request.method == "GET":
+        return httpx.Response(200, json={"nonce": mocked__get_nonce(None)})
+    r = mocked_requests_post(str(request.url), json=json.loads(request.content))
+    return httpx.Response(r.status_code, json=r.json())
+
+
+@unittest.skipUnless(httpx, "asgi dependencies are not installed")
+class AsgiTest(unittest.TestCase):
+    def setUp(self):
+        matrix_registration.config.config = Config(data=GOOD_CONFIG)
+        matrix_registration.matrix_api._breakers.clear()
+        app = create_app(testing=True)
+        with app.app_context():
+            app.config.from_mapping(
+                SQLALCHEMY_DATABASE_URI=matrix_registration.config.config.db,
+                SQLALCHEMY_TRACK_MODIFICATIONS=False,
+            )
+            db.init_app(app)
+            db.create_all()
+            matrix_registration.tokens.tokens = matrix_registration.tokens.Tokens()
+        self.app = app
+        self.asgi = RegistrationApp(app)
+        self.asgi.client = httpx.AsyncClient(
+            transport=httpx.MockTransport(mocked_homeserver)
+        )
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+        matrix_registration.matrix_api._breakers.clear()
+
+    def request(self, method, path, **kwargs):
+        async def send():
+            transport = httpx.ASGITransport(app=self.asgi)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://localhost"
+            ) as client:
+                return await client.request(method, path, **kwargs)
+
+        return asyncio.run(send())
+
+    @parameterized.expand(
+        [
+            ["asgi1", "password", "password", True, 200],
+            ["asgi2", "password", "wordpass", True, 400],
+            ["asgi3", "password", "password", False, 400],
+            ["admin", "password", "password", True, 400],
+        ]
+    )
+    def test_register(self, username, password, confirm, active, status):
+        with self.app.app_context():
+            test_token = matrix_registration.tokens.tokens.new(max_usage=1)
+            if not active:
+                matrix_registration.tokens.tokens.disable(test_token.name)
+        rv = self.request(
+            "POST",
+            "/register",
+            data=dict(
+                username=username,
+                password=password,
+                confirm=confirm,
+                token=test_token.name,
+            ),
+        )
+        self.assertEqual(rv.status_code, status)
+        with self.app.app_context():
+            token = matrix_registration.tokens.tokens.get_token(test_token.name)
+            if status == 200:
+                self.assertTrue(rv.json()["user_id"].startswith("@%s:" % username))
+                self.assertEqual(token.used, 1)
+            else:
+                self.assertEqual(rv.json()["errcode"], "MR_BAD_USER_REQUEST")
+                self.assertEqual(token.used, 0)
+
+    def test_register_wrong_secret(self):
+        matrix_registration.config.config = Config(data=BAD_CONFIG3)
+        with self.app.app_context():
+            test_token = matrix_registration.tokens.tokens.new(max_usage=1)
+        rv = self.request(
+            "POST",
+            "/register",
+            data=dict(
+                username="username",
+                password="password",
+                confirm="password",
+                token=test_token.name,
+            ),
+        )
+        self.assertEqual(rv.status_code, 500)
+        with self.app.app_context():
+            # the reserved usage is given back if the hs fails
+            self.assertTrue(matrix_registration.tokens.tokens.active(test_token.name))
+
+    def test_passthrough(self):
+        rv = self.request("GET", "/register")
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b"matrix.org", rv.content)
+
+        rv = self.request("GET", "/api/token")
+        self.assertEqual(rv.status_code, 401)
+
+
 class CliTest(unittest.TestCase):
     path = "tests/test_config.yaml"
     db = "tests/db.sqlite"
@@ -953,6 +2367,81 @@ class CliTest(unittest.TestCase):
         list = status.output.strip()
         self.assertEqual(list, f"{name1}, {name2}")
 
+    def test_help_without_config(self):
+        matrix_registration.config.config = None
+        result = CliRunner().invoke(cli, ["--help"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertNotIn("Traceback", result.output)
+        self.assertIn("generate", result.output)
+        # nothing ran that creates the database, which tearDown removes
+        open(self.db, "a").close()
+
+    def test_generate_count(self):
+        runner = create_app().test_cli_runner()
+        result = runner.invoke(cli, ["--config-path", self.path, "generate", "-c", 0])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("'--count': 0 is not in the range", result.output)
+
+    def test_breached_hashes(self):
+        source = "tests/breached.txt"
+        target = "tests/breached.bin"
+        with open(source, "w") as f:
+            for line in sorted(
+                hashlib.sha1(p).hexdigest().upper() for p in [b"password", b"hunter2"]
+            ):
+                f.write("%s:42\n" % line)
+        runner = create_app().test_cli_runner()
+        result = runner.invoke(
+            cli, ["--config-path", self.path, "breached-hashes", "-p", 10, source, target]
+        )
+        self.assertEqual(result.output.strip(), f"2 hashes written to {target}")
+        hashes = matrix_registration.sortedfile.HashFile(target)
+        self.assertEqual(hashes.record_length, 10)
+        self.assertIn(hashlib.sha1(b"hunter2").digest(), hashes)
+        hashes.close()
+        os.remove(source)
+        os.remove(target)
+
+    def test_blocklist(self):
+        source = "tests/blocklist.txt"
+        target = "tests/blocklist.sorted"
+        with open(source, "w") as f:
+            f.write("Support\nroot\n\nadmin\nSUPPORT\n")
+        runner = create_app().test_cli_runner()
+        result = runner.invoke(
+            cli, ["--config-path", self.path, "blocklist", source, target]
+        )
+        self.assertEqual(result.output.strip(), f"3 usernames written to {target}")
+        with open(target) as f:
+            self.assertEqual(f.read(), "admin\nroot\nsupport\n")
+        os.remove(source)
+        os.remove(target)
+
+
+    def test_compress_static(self):
+        directory = "tests/static"
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{directory}/style.css", "w") as f:
+            f.write("body { color: black; }\n" * 100)
+        with open(f"{directory}/image.png", "wb") as f:
+            f.write(os.urandom(1000))
+        runner = create_app().test_cli_runner()
+        result = runner.invoke(
+            cli, ["--config-path", self.path, "compress-static", directory]
+        )
+        written = 2 if matrix_registration.caching.brotli else 1
+        self.assertEqual(
+            result.output.strip(), f"{written} compressed files written to {directory}"
+        )
+        with open(f"{directory}/style.css.gz", "rb") as f:
+            compressed = f.read()
+        self.assertFalse(os.path.exists(f"{directory}/image.png.gz"))
+        # the precompressed files are served instead of compressing again
+        assets = Assets(directory)
+        self.assertEqual(assets.files["style.css"].bodies["gzip"], compressed)
+        self.assertNotIn("style.css.gz", assets.files)
+        shutil.rmtree(directory)
+
 
 if "logging" in sys.argv:
     logging.basicConfig(level=logging.DEBUG)